@@ -5,20 +5,27 @@ It handles Gmail authentication, email scanning, and unsubscription processing.
 """
 
 import os
+import sys
+import copy
 import json
-import base64
+import binascii
 import re
 import time
 import logging
 import secrets
 import uuid
+from email.utils import parseaddr
 from datetime import datetime, timedelta
-from functools import wraps
+from functools import wraps, lru_cache
+import threading
 from threading import Thread, Lock
+from concurrent.futures import ThreadPoolExecutor
 from queue import Queue
-from collections import defaultdict
+from collections import defaultdict, OrderedDict, deque
+from urllib.parse import urlsplit
 
-from flask import Flask, request, jsonify, redirect, g, session
+from flask import Flask, Response, request, jsonify, redirect, g, session, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 import jwt
 from flask_cors import CORS
 from werkzeug.middleware.proxy_fix import ProxyFix
@@ -27,9 +34,31 @@ from google_auth_oauthlib.flow import Flow
 from google.auth.transport.requests import Request
 from googleapiclient.discovery import build
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from bs4 import BeautifulSoup
 from dotenv import load_dotenv
 
+# Prefer lxml's C parser for email HTML, fall back to the stdlib parser
+try:
+    import lxml.html
+    HTML_PARSER = 'lxml'
+except ImportError:
+    lxml = None
+    HTML_PARSER = 'html.parser'
+
+# pybase64's SIMD decoder is faster on large email bodies; binascii is the fallback
+try:
+    import pybase64
+except ImportError:
+    pybase64 = None
+
+# orjson serializes API responses several times faster than the stdlib json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # Load environment variables
 load_dotenv()
 
@@ -64,7 +93,12 @@ if os.environ.get('OAUTHLIB_INSECURE_TRANSPORT') == '1':
 
 # Import Claude chat functionality
 try:
-    from chat import chat_simple, chat_with_gmail_context, ask_claude
+    from chat import chat_simple, chat_stream, chat_with_gmail_context, ask_claude, CLAUDE_MD_PATH
+    # The chat manager is created lazily, so check its prerequisites up front
+    if not os.environ.get('ANTHROPIC_API_KEY'):
+        raise ValueError("ANTHROPIC_API_KEY environment variable not set")
+    if not CLAUDE_MD_PATH.exists():
+        raise FileNotFoundError(f"CLAUDE.md not found at {CLAUDE_MD_PATH}")
     CLAUDE_AVAILABLE = True
     logger.info("Claude chat module loaded successfully")
 except Exception as e:
@@ -78,8 +112,39 @@ handler = logging.StreamHandler()
 handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
 oauth_logger.addHandler(handler)
 
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson.
+
+    Output matches the default provider: sorted keys, dates as HTTP dates,
+    and indented responses in debug mode. Calls passing json.dumps options
+    go through the default provider.
+    """
+
+    options = orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME if orjson else 0
+
+    def dumps(self, obj, **kwargs):
+        if kwargs:
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default, option=self.options).decode()
+
+    def loads(self, s, **kwargs):
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        option = self.options | orjson.OPT_APPEND_NEWLINE
+        if (self.compact is None and self._app.debug) or self.compact is False:
+            option |= orjson.OPT_INDENT_2
+        return self._app.response_class(
+            orjson.dumps(obj, default=self.default, option=option), mimetype=self.mimetype
+        )
+
 # Initialize Flask app
 app = Flask(__name__)
+if orjson is not None:
+    app.json = OrjsonProvider(app)
 app.secret_key = os.environ.get('SECRET_KEY', secrets.token_hex(16))
 
 # Add ProxyFix middleware to handle X-Forwarded headers properly
@@ -154,19 +219,148 @@ SCOPES = [
 API_SERVICE_NAME = 'gmail'
 API_VERSION = 'v1'
 
+# Maximum page size accepted by messages.list
+GMAIL_LIST_PAGE_SIZE = 500
+
+# Headers needed to unsubscribe without downloading the message body
+UNSUB_METADATA_HEADERS = ['From', 'Subject', 'Date', 'List-Unsubscribe', 'List-Unsubscribe-Post']
+
+# Partial response mask for messages.get: only the headers and the MIME tree
+# (type + inline body data, three levels deep) needed to find the HTML part
+EMAIL_CONTENT_FIELDS = (
+    'id,payload(mimeType,headers,body/data,'
+    'parts(mimeType,body/data,parts(mimeType,body/data,parts(mimeType,body/data))))'
+)
+
+MAX_ACTIVITIES_PER_USER = 50
+
 user_stats = {}
-user_activities = {}
+user_activities = {}  # user_id -> deque of activities, newest first
 oauth_states = set()
 oauth_states_with_timestamp = {}  # Store states with timestamps for cleanup
 
 # Background task processing infrastructure
 processing_operations = {}  # operation_id -> operation status dict
 processing_lock = Lock()
+user_scan_operations = {}  # user_id -> operation_id of the latest unsubscription scan
 
 # Stats caching infrastructure
 stats_cache = {}  # user_id -> (stats_dict, timestamp)
 CACHE_TTL_SECONDS = 60  # Cache stats for 60 seconds
 
+# Unsubscribe outcome cache: links that already unsubscribed successfully
+unsub_success_cache = OrderedDict()  # (user_id, normalized link) -> True, in LRU order
+unsub_cache_lock = Lock()
+UNSUB_CACHE_MAX_ENTRIES = 2048
+
+# Gmail credentials cache: one live Credentials object per user so requests
+# reuse the same access token instead of rebuilding it from the JWT each time
+user_credentials = {}  # user_id -> google.oauth2.credentials.Credentials
+user_credentials_locks = {}  # user_id -> Lock serializing token refreshes
+credentials_registry_lock = Lock()
+
+# Shared HTTP session for unsubscribe requests so repeated hits on the same
+# ESP host (SendGrid, Mailchimp, ...) reuse warm TCP/TLS connections
+unsub_session = requests.Session()
+unsub_session.headers.update({
+    'User-Agent': 'Gmail-Unsubscriber/1.0',
+    'Accept': 'text/html'
+})
+unsub_adapter = HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=32,
+    max_retries=Retry(total=2, backoff_factor=0.3)
+)
+unsub_session.mount('https://', unsub_adapter)
+unsub_session.mount('http://', unsub_adapter)
+
+# Shared HTTP session for Google's OAuth endpoints (token refresh, userinfo)
+# so each call skips the TCP/TLS handshake to oauth2.googleapis.com
+google_session = requests.Session()
+google_session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
+class TokenBucket:
+    """Thread-safe token bucket: allows bursts up to capacity, refills at rate/sec."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = Lock()
+
+    def acquire(self, cost=1):
+        """Take cost tokens, blocking only while the bucket is empty."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= cost:
+                    self.tokens -= cost
+                    return
+                wait = (cost - self.tokens) / self.rate
+            time.sleep(wait)
+
+# Gmail API quota: 250 units/sec per user; messages.get and modify cost 5 each
+GMAIL_QUOTA_UNITS_PER_SECOND = 250
+GMAIL_GET_COST = 5
+GMAIL_MODIFY_COST = 5
+# batchModify applies one label change to up to 1000 messages for 50 units
+GMAIL_BATCH_MODIFY_COST = 50
+GMAIL_BATCH_MODIFY_MAX_IDS = 1000
+gmail_quota_buckets = {}  # user_id -> TokenBucket
+
+# Parallel Gmail calls per apply operation; the quota bucket still caps the rate
+APPLY_MAX_WORKERS = 16
+gmail_quota_lock = Lock()
+
+# Unsubscribe requests hit third-party sites, so they get their own limiters,
+# one per target host: polite to each ESP without making users queue behind
+# each other
+UNSUB_HOST_RATE = 5
+UNSUB_HOST_BURST = 10
+UNSUB_HOST_BUCKETS_MAX = 1024
+unsub_host_buckets = OrderedDict()  # host -> TokenBucket, in LRU order
+unsub_host_lock = Lock()
+
+def get_gmail_bucket(user_id):
+    """Return the per-user Gmail quota bucket, creating it on first use."""
+    with gmail_quota_lock:
+        bucket = gmail_quota_buckets.get(user_id)
+        if bucket is None:
+            bucket = TokenBucket(GMAIL_QUOTA_UNITS_PER_SECOND, GMAIL_QUOTA_UNITS_PER_SECOND)
+            gmail_quota_buckets[user_id] = bucket
+        return bucket
+
+def get_unsub_bucket(url):
+    """Return the rate limiter for an unsubscribe URL's host, creating it on first use."""
+    host = urlsplit(url).hostname or ''
+    with unsub_host_lock:
+        bucket = unsub_host_buckets.get(host)
+        if bucket is None:
+            bucket = TokenBucket(UNSUB_HOST_RATE, UNSUB_HOST_BURST)
+            unsub_host_buckets[host] = bucket
+            if len(unsub_host_buckets) > UNSUB_HOST_BUCKETS_MAX:
+                unsub_host_buckets.popitem(last=False)
+        else:
+            unsub_host_buckets.move_to_end(host)
+        return bucket
+
+# Maps the base64url alphabet onto standard base64 for binascii
+_B64_URLSAFE_TRANS = str.maketrans('-_', '+/')
+
+# Unsubscribe wording in link text or href, e.g. "opt_out", "email-preferences",
+# "manage your preferences". Words ([^\W_]) and separators ([-_\s]) never
+# overlap, so hostile input like "email-email-..." cannot cause backtracking
+_UNSUB_RE = re.compile(
+    r'unsubscribe|opt[-_\s]?out|(?:manage|email)[-_\s]+(?:[^\W_]+[-_\s]+){0,2}preferences',
+    re.I
+)
+
+# HTTP(S) URLs inside a List-Unsubscribe header
+_LIST_UNSUB_URL_RE = re.compile(r'<(https?://[^>]+)>', re.I)
+
 # Initialize database and load existing data
 try:
     db_success = initialize_database()
@@ -177,11 +371,18 @@ try:
             loaded_stats = db_manager.load_user_stats()
             loaded_activities = db_manager.load_user_activities()
             
-            # Merge with in-memory data (database takes precedence)
-            user_stats.update(loaded_stats)
-            user_activities.update(loaded_activities)
+            # Merge with in-memory data (database takes precedence); loader
+            # results are cached and shared, so copy before they are mutated
+            user_stats.update(copy.deepcopy(loaded_stats))
+            user_activities.update(
+                (uid, deque(activities, maxlen=MAX_ACTIVITIES_PER_USER))
+                for uid, activities in loaded_activities.items()
+            )
             
             logger.info(f"Loaded data for {len(loaded_stats)} users with stats and {len(loaded_activities)} users with activities")
+
+            # Don't carry open SQLite connections across gunicorn's fork
+            db_manager.close()
         else:
             logger.warning("Database manager not available after initialization")
     else:
@@ -257,6 +458,44 @@ def decode_token(token):
         logger.error(f"Invalid token: {e}")
         return None
 
+def get_user_credentials_lock(user_id):
+    """Return the Lock serializing token refreshes for a user's cached Credentials."""
+    with credentials_registry_lock:
+        return user_credentials_locks.setdefault(user_id, Lock())
+
+def get_user_credentials(user_id, creds_data):
+    """Return the cached Credentials for a user, refreshing them if expired.
+
+    Returns None when the credentials are invalid and cannot be refreshed.
+    """
+    with get_user_credentials_lock(user_id):
+        creds = user_credentials.get(user_id)
+        # A new login issues a new refresh token; rebuild from the JWT then
+        if creds is None or creds.refresh_token != creds_data.get('refresh_token'):
+            creds = Credentials.from_authorized_user_info(creds_data, SCOPES)
+            user_credentials[user_id] = creds
+
+        if not creds.valid:
+            if creds.expired and creds.refresh_token:
+                creds.refresh(Request(session=google_session))
+            else:
+                return None
+
+        return creds
+
+
+def copy_user_credentials(user_id, credentials):
+    """Return a private copy of a user's cached Credentials for one Gmail service.
+
+    The shared object is refreshed under the user's lock first; a refresh the
+    transport triggers later only touches the copy, so concurrent requests
+    and background threads never refresh the same object at once.
+    """
+    with get_user_credentials_lock(user_id):
+        if not credentials.valid and credentials.refresh_token:
+            credentials.refresh(Request(session=google_session))
+        return copy.copy(credentials)
+
 def is_authenticated(token):
     """Validate token and refresh Gmail credentials if needed."""
     payload = decode_token(token)
@@ -267,19 +506,16 @@ def is_authenticated(token):
     if not creds_data:
         return None
 
-    creds = Credentials.from_authorized_user_info(creds_data, SCOPES)
+    try:
+        creds = get_user_credentials(payload.get('user_id'), creds_data)
+    except Exception as e:
+        logger.error(f"Error refreshing credentials: {e}")
+        return None
 
-    if not creds.valid:
-        if creds.expired and creds.refresh_token:
-            try:
-                creds.refresh(Request())
-                payload["credentials"] = json.loads(creds.to_json())
-            except Exception as e:
-                logger.error(f"Error refreshing credentials: {e}")
-                return None
-        else:
-            return None
+    if creds is None:
+        return None
 
+    payload["credentials"] = creds
     return payload
 
 # Authentication required decorator
@@ -297,7 +533,9 @@ def auth_required(f):
         if not payload:
             return jsonify({"error": "Authentication required"}), 401
 
-        g.user_id = payload.get('user_id')
+        # Interned so the per-request user_stats / user_activities lookups compare by identity
+        user_id = payload.get('user_id')
+        g.user_id = sys.intern(user_id) if isinstance(user_id, str) else user_id
         g.credentials = payload.get('credentials')
         return f(*args, **kwargs)
 
@@ -566,7 +804,7 @@ def oauth2callback():
         user_info = get_user_info(credentials)
         oauth_logger.info(f"User info retrieved: {user_info}")
         
-        user_id = user_info['email']
+        user_id = sys.intern(user_info['email'])
         oauth_logger.info(f"User ID: {user_id}")
 
         # NOW clear state from session after successful authentication
@@ -590,7 +828,7 @@ def oauth2callback():
             if db_manager:
                 loaded_stats = db_manager.load_user_stats()
                 if user_id in loaded_stats:
-                    user_stats[user_id] = loaded_stats[user_id]
+                    user_stats[user_id] = copy.deepcopy(loaded_stats[user_id])
                     # Ensure emails_deleted field exists
                     if 'emails_deleted' not in user_stats[user_id]:
                         user_stats[user_id]['emails_deleted'] = 0
@@ -622,7 +860,7 @@ def oauth2callback():
                 "message": "Successfully connected Gmail account",
                 "time": datetime.now().isoformat()
             }
-            user_activities[user_id] = [activity]
+            user_activities[user_id] = deque([activity], maxlen=MAX_ACTIVITIES_PER_USER)
             oauth_logger.info(f"Initialized activities for user: {user_id}")
             save_activity_to_db(user_id, activity)
         
@@ -688,7 +926,8 @@ def oauth2callback():
 @app.route('/api/auth/logout', methods=['POST'])
 @auth_required
 def logout():
-    """Client-side logout. No server state is stored."""
+    """Client-side logout. Only the cached Gmail credentials are dropped."""
+    user_credentials.pop(g.user_id, None)
     return jsonify({"success": True, "message": "Logged out"})
 
 @app.route('/api/auth/debug', methods=['GET'])
@@ -811,7 +1050,7 @@ def get_activities():
     """Get the user's recent activities."""
     user_id = g.get('user_id')
     
-    return jsonify(user_activities.get(user_id, []))
+    return jsonify(list(user_activities.get(user_id, [])))
 
 @app.route('/api/unsubscribed-services', methods=['GET'])
 @auth_required
@@ -850,18 +1089,52 @@ def start_unsubscription():
     
     search_query = data.get('search_query', '"unsubscribe" OR "email preferences" OR "opt-out" OR "subscription preferences"')
     max_emails = data.get('max_emails', 50)
+    label_ids = data.get('label_ids')
     
+    # Only one scan per user at a time: check and claim the slot in one step
+    # so two concurrent starts cannot both pass the check
+    operation_id = str(uuid.uuid4())
+    with processing_lock:
+        running_operation_id = user_scan_operations.get(user_id)
+        running_status = processing_operations.get(running_operation_id) if running_operation_id else None
+        already_running = bool(running_status and running_status.get('status') == 'processing')
+        if not already_running:
+            processing_operations[operation_id] = {
+                'status': 'processing',
+                'progress': {'processed': 0, 'total': max_emails, 'current_email_info': None}
+            }
+            user_scan_operations[user_id] = operation_id
+
+    if already_running:
+        return jsonify({
+            "success": False,
+            "error": "An unsubscription process is already running",
+            "operation_id": running_operation_id
+        }), 409
+
     # Add activity
     add_activity(user_id, "info", f"Started unsubscription process with query: {search_query}")
     
-    # Start the process in a background thread (in a real app)
-    # For demo purposes, we'll do it synchronously
     try:
-        process_unsubscriptions(user_id, search_query, max_emails, g.credentials)
-        return jsonify({"success": True, "message": "Unsubscription process completed"})
+        # Run the scan in a background thread so the request returns immediately
+        thread = Thread(
+            target=run_unsubscription_scan,
+            args=(operation_id, user_id, search_query, max_emails, g.credentials, label_ids),
+            daemon=True
+        )
+        thread.start()
+
+        return jsonify({
+            "success": True,
+            "operation_id": operation_id,
+            "status": "started",
+            "message": "Unsubscription process started. Poll /api/unsubscribe/status for progress."
+        }), 202
     except Exception as e:
-        logger.error(f"Error in unsubscription process: {e}")
+        logger.error(f"Error starting unsubscription process: {e}")
         add_activity(user_id, "error", f"Error in unsubscription process: {str(e)}")
+        # Release the user's scan slot
+        update_operation_status(operation_id, {'status': 'error', 'error': str(e)})
         return jsonify({"success": False, "error": str(e)}), 500
 
 @app.route('/api/unsubscribe/status', methods=['GET'])
@@ -870,12 +1143,18 @@ def get_unsubscription_status():
     """Get the status of the unsubscription process."""
     user_id = g.get('user_id')
 
-    # In a real app, this would check the status of the background process
-    # For demo purposes, we'll just return the stats
-    return jsonify({
+    response = {
         "stats": user_stats.get(user_id, {}),
-        "activities": user_activities.get(user_id, [])
-    })
+        "activities": list(user_activities.get(user_id, []))
+    }
+
+    # Include progress of the latest background scan, if any
+    operation_id = user_scan_operations.get(user_id)
+    operation_status = get_operation_status(operation_id) if operation_id else None
+    if operation_status:
+        response["processing"] = dict(operation_status, operation_id=operation_id)
+
+    return jsonify(response)
 
 @app.route('/api/unsubscribe/preview', methods=['POST'])
 @auth_required
@@ -886,16 +1165,15 @@ def preview_unsubscribe_candidates():
 
     search_query = data.get('search_query', '"unsubscribe" OR "email preferences" OR "opt-out"')
     max_emails = data.get('max_emails', 50)
+    label_ids = data.get('label_ids')
 
     try:
         # Build Gmail service
-        creds = Credentials.from_authorized_user_info(g.credentials, SCOPES)
-        if not creds.valid and creds.refresh_token:
-            creds.refresh(Request())
-        service = build(API_SERVICE_NAME, API_VERSION, credentials=creds)
+        service = build(API_SERVICE_NAME, API_VERSION,
+                        credentials=copy_user_credentials(g.user_id, g.credentials))
 
         # Search for emails
-        messages = search_emails(service, search_query, max_emails)
+        messages = search_emails(service, search_query, max_emails, label_ids)
 
         if not messages:
             return jsonify({
@@ -953,6 +1231,78 @@ def preview_unsubscribe_candidates():
             "candidates": []
         }), 500
 
+def _process_apply_item(item, credentials, unsubscribed_label_id, gmail_bucket, thread_state):
+    """Run the Gmail and unsubscribe calls for one apply item.
+
+    Called from the apply worker pool, so it only does I/O and reports what
+    happened; process_unsubscribe_async updates stats and activities and
+    labels the messages flagged with 'archive' in bulk.
+    """
+    # googleapiclient services share one httplib2 connection and are not
+    # thread-safe, so each worker thread builds its own. It also gets its own
+    # copy of the credentials, so a refresh inside the transport never races
+    # other workers or the operation thread
+    service = getattr(thread_state, 'service', None)
+    if service is None:
+        service = thread_state.service = build(API_SERVICE_NAME, API_VERSION,
+                                               credentials=copy.copy(credentials))
+
+    msg_id = item.get('id')
+    action = item.get('action')
+
+    # Get full message for metadata
+    gmail_bucket.acquire(GMAIL_GET_COST)
+    message = service.users().messages().get(
+        userId='me',
+        id=msg_id,
+        format='metadata',
+        metadataHeaders=['From', 'Subject', 'List-Unsubscribe', 'List-Unsubscribe-Post']
+    ).execute()
+
+    metadata = extract_email_metadata(message)
+    result = {
+        'action': action,
+        'metadata': metadata,
+        'one_click': action == 'one_click_unsub' and metadata['has_rfc8058_one_click'],
+        'unsubscribed': False,
+        'archive': False,
+        'payload_item': None
+    }
+
+    if result['one_click']:
+        # Execute RFC 8058 one-click unsubscribe
+        result['unsubscribed'] = execute_rfc8058_unsub(metadata['rfc8058_unsub_url'])
+
+        # Label and archive the email (batched by the caller)
+        if result['unsubscribed'] and unsubscribed_label_id:
+            result['archive'] = True
+            result['payload_item'] = {
+                'message_id': msg_id,
+                'removed_labels': ['INBOX'],
+                'added_labels': [unsubscribed_label_id],
+                'one_click_unsub': True
+            }
+
+    elif action == 'label_archive' or action == 'delete':
+        # Label and archive or delete the email
+        if action == 'delete':
+            # Trash the email
+            gmail_bucket.acquire(GMAIL_MODIFY_COST)
+            service.users().messages().trash(userId='me', id=msg_id).execute()
+        elif unsubscribed_label_id:
+            # Label and archive (batched by the caller)
+            result['archive'] = True
+
+        result['payload_item'] = {
+            'message_id': msg_id,
+            'removed_labels': ['INBOX'] if action != 'delete' else [],
+            'added_labels': [unsubscribed_label_id] if unsubscribed_label_id and action != 'delete' else [],
+            'one_click_unsub': False,
+            'deleted': action == 'delete'
+        }
+
+    return result
+
 def process_unsubscribe_async(operation_id, user_id, items, create_filters, credentials):
     """Background worker for unsubscribe operations."""
     try:
@@ -969,11 +1319,9 @@ def process_unsubscribe_async(operation_id, user_id, items, create_filters, cred
             'failed': 0
         })
 
-        # Build Gmail service
-        creds = Credentials.from_authorized_user_info(credentials, SCOPES)
-        if not creds.valid and creds.refresh_token:
-            creds.refresh(Request())
-        service = build(API_SERVICE_NAME, API_VERSION, credentials=creds)
+        # Build Gmail service on this operation's own copy of the credentials
+        credentials = copy_user_credentials(user_id, credentials)
+        service = build(API_SERVICE_NAME, API_VERSION, credentials=credentials)
 
         # Get/create UNSUBSCRIBED label
         unsubscribed_label_id = ensure_label_exists(service, 'UNSUBSCRIBED')
@@ -989,120 +1337,136 @@ def process_unsubscribe_async(operation_id, user_id, items, create_filters, cred
         success_count = 0
         failed_count = 0
         emails_deleted_count = 0
+        archive_ids = []
+        archive_metadata = {}  # msg_id -> metadata, reported once the batch label change lands
+        one_click_ids = set()
+
+        # Gmail calls are I/O bound, so overlap them on a small pool; shared
+        # stats are only touched here, as results come back in item order
+        gmail_bucket = get_gmail_bucket(user_id)
+        thread_state = threading.local()
+        max_workers = max(1, min(APPLY_MAX_WORKERS, len(items)))
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='apply') as executor:
+            futures = [
+                executor.submit(_process_apply_item, item, credentials, unsubscribed_label_id,
+                                gmail_bucket, thread_state)
+                for item in items
+            ]
 
-        for idx, item in enumerate(items):
-            msg_id = item.get('id')
-            action = item.get('action')
+            for idx, (item, future) in enumerate(zip(items, futures)):
+                msg_id = item.get('id')
 
-            try:
-                # Update progress
-                update_operation_status(operation_id, {
-                    'progress': idx + 1,
-                    'current_item': f"Processing {idx + 1}/{len(items)}"
-                })
+                try:
+                    # Update progress
+                    update_operation_status(operation_id, {
+                        'progress': idx + 1,
+                        'current_item': f"Processing {idx + 1}/{len(items)}"
+                    })
 
-                # Get full message for metadata
-                message = service.users().messages().get(
-                    userId='me',
-                    id=msg_id,
-                    format='metadata',
-                    metadataHeaders=['From', 'Subject', 'List-Unsubscribe', 'List-Unsubscribe-Post']
-                ).execute()
+                    result = future.result()
+                    action = result['action']
+                    metadata = result['metadata']
+
+                    if result['one_click']:
+                        one_click_ids.add(msg_id)
+                        if result['unsubscribed']:
+                            add_activity(user_id, "success",
+                                       f"Unsubscribed via RFC 8058 from {metadata['sender_name']}",
+                                       metadata)
+                            user_stats[user_id]["total_unsubscribed"] += 1
+
+                            # Track domain statistics
+                            domain = metadata.get("domain", "unknown")
+                            if domain:
+                                if domain not in user_stats[user_id]["domains_unsubscribed"]:
+                                    user_stats[user_id]["domains_unsubscribed"][domain] = {
+                                        "count": 0,
+                                        "sender_name": metadata.get("sender_name", domain),
+                                        "emails": set()
+                                    }
+                                user_stats[user_id]["domains_unsubscribed"][domain]["count"] += 1
+                                if metadata.get("sender_email"):
+                                    add_domain_email(user_stats[user_id]["domains_unsubscribed"][domain], metadata.get("sender_email"))
+
+                            success_count += 1
+                        else:
+                            add_activity(user_id, "error",
+                                       f"Failed RFC 8058 unsubscribe for {metadata['sender_name']}",
+                                       metadata)
+                            failed_count += 1
+
+                    elif action == 'label_archive' or action == 'delete':
+                        if action == 'delete':
+                            emails_deleted_count += 1
+                            add_activity(user_id, "success",
+                                       f"Deleted email from {metadata['sender_name']}",
+                                       metadata)
+                            success_count += 1
+                        elif not result['archive']:
+                            add_activity(user_id, "success",
+                                       f"Labeled and archived email from {metadata['sender_name']}",
+                                       metadata)
+                            success_count += 1
+
+                    if result['archive']:
+                        archive_ids.append(msg_id)
+                        archive_metadata[msg_id] = metadata
+                    if result['payload_item']:
+                        operation_payload['items'].append(result['payload_item'])
+
+                    # Track sender for filter creation
+                    if metadata['sender_email']:
+                        processed_senders.add(metadata['sender_email'])
+
+                    # Update stats
+                    user_stats[user_id]["total_scanned"] += 1
 
-                metadata = extract_email_metadata(message)
+                    # Invalidate cache after each successful operation
+                    invalidate_stats_cache(user_id)
+
+                except Exception as e:
+                    logger.error(f"Error processing item {msg_id}: {e}")
+                    add_activity(user_id, "error", f"Failed to process email: {str(e)}")
+                    failed_count += 1
+                    update_operation_status(operation_id, {
+                        'errors': get_operation_status(operation_id)['errors'] + [str(e)]
+                    })
 
-                if action == 'one_click_unsub' and metadata['has_rfc8058_one_click']:
-                    # Execute RFC 8058 one-click unsubscribe
-                    if execute_rfc8058_unsub(metadata['rfc8058_unsub_url']):
-                        add_activity(user_id, "success",
-                                   f"Unsubscribed via RFC 8058 from {metadata['sender_name']}",
+        # Label and archive everything in one batchModify per 1000 messages
+        if archive_ids:
+            failed_ids = set(batch_modify_labels(service, archive_ids, [unsubscribed_label_id], ['INBOX'],
+                                                 gmail_bucket))
+
+            # Report label_archive items only now that the outcome is known;
+            # one-click items already counted their unsubscribe above
+            for archived_id in archive_ids:
+                metadata = archive_metadata[archived_id]
+                one_click = archived_id in one_click_ids
+                if archived_id in failed_ids:
+                    if one_click:
+                        add_activity(user_id, "warning",
+                                   f"Unsubscribed from {metadata['sender_name']} but failed to label and archive the email",
                                    metadata)
-                        user_stats[user_id]["total_unsubscribed"] += 1
-
-                        # Track domain statistics
-                        domain = metadata.get("domain", "unknown")
-                        if domain:
-                            if domain not in user_stats[user_id]["domains_unsubscribed"]:
-                                user_stats[user_id]["domains_unsubscribed"][domain] = {
-                                    "count": 0,
-                                    "sender_name": metadata.get("sender_name", domain),
-                                    "emails": set()
-                                }
-                            user_stats[user_id]["domains_unsubscribed"][domain]["count"] += 1
-                            if metadata.get("sender_email"):
-                                user_stats[user_id]["domains_unsubscribed"][domain]["emails"].add(metadata.get("sender_email"))
-
-                        success_count += 1
-
-                        # Label and archive the email
-                        if unsubscribed_label_id:
-                            service.users().messages().modify(
-                                userId='me',
-                                id=msg_id,
-                                body={'removeLabelIds': ['INBOX'], 'addLabelIds': [unsubscribed_label_id]}
-                            ).execute()
-
-                            operation_payload['items'].append({
-                                'message_id': msg_id,
-                                'removed_labels': ['INBOX'],
-                                'added_labels': [unsubscribed_label_id],
-                                'one_click_unsub': True
-                            })
                     else:
                         add_activity(user_id, "error",
-                                   f"Failed RFC 8058 unsubscribe for {metadata['sender_name']}",
+                                   f"Failed to label and archive email from {metadata['sender_name']}",
                                    metadata)
                         failed_count += 1
-
-                elif action == 'label_archive' or action == 'delete':
-                    # Label and archive or delete the email
-                    if action == 'delete':
-                        # Trash the email
-                        service.users().messages().trash(userId='me', id=msg_id).execute()
-                        emails_deleted_count += 1
-
-                        add_activity(user_id, "success",
-                                   f"Deleted email from {metadata['sender_name']}",
-                                   metadata)
-                    else:
-                        # Label and archive
-                        if unsubscribed_label_id:
-                            service.users().messages().modify(
-                                userId='me',
-                                id=msg_id,
-                                body={'removeLabelIds': ['INBOX'], 'addLabelIds': [unsubscribed_label_id]}
-                            ).execute()
-
-                        add_activity(user_id, "success",
-                                   f"Labeled and archived email from {metadata['sender_name']}",
-                                   metadata)
-
+                elif not one_click:
+                    add_activity(user_id, "success",
+                               f"Labeled and archived email from {metadata['sender_name']}",
+                               metadata)
                     success_count += 1
 
-                    operation_payload['items'].append({
-                        'message_id': msg_id,
-                        'removed_labels': ['INBOX'] if action != 'delete' else [],
-                        'added_labels': [unsubscribed_label_id] if unsubscribed_label_id and action != 'delete' else [],
-                        'one_click_unsub': False,
-                        'deleted': action == 'delete'
-                    })
-
-                # Track sender for filter creation
-                if metadata['sender_email']:
-                    processed_senders.add(metadata['sender_email'])
-
-                # Update stats
-                user_stats[user_id]["total_scanned"] += 1
-
-                # Invalidate cache after each successful operation
-                invalidate_stats_cache(user_id)
-
-            except Exception as e:
-                logger.error(f"Error processing item {msg_id}: {e}")
-                add_activity(user_id, "error", f"Failed to process email: {str(e)}")
-                failed_count += 1
+            if failed_ids:
+                # Messages that kept their labels have nothing to undo
+                operation_payload['items'] = [
+                    payload_item for payload_item in operation_payload['items']
+                    if payload_item['message_id'] not in failed_ids
+                ]
                 update_operation_status(operation_id, {
-                    'errors': get_operation_status(operation_id)['errors'] + [str(e)]
+                    'errors': get_operation_status(operation_id)['errors'] +
+                              [f"Failed to label and archive {len(failed_ids)} emails"]
                 })
 
         # Create filters if requested
@@ -1258,34 +1622,30 @@ def undo_unsubscribe_operation():
             return jsonify({"error": "Operation already undone"}), 400
 
         # Build Gmail service
-        creds = Credentials.from_authorized_user_info(g.credentials, SCOPES)
-        if not creds.valid and creds.refresh_token:
-            creds.refresh(Request())
-        service = build(API_SERVICE_NAME, API_VERSION, credentials=creds)
+        service = build(API_SERVICE_NAME, API_VERSION,
+                        credentials=copy_user_credentials(g.user_id, g.credentials))
 
         # Revert message label changes
         reverted_count = 0
         one_click_count = 0
 
+        # Group messages by label change so each group reverts in one batchModify
+        revert_groups = defaultdict(list)
         for item in operation.get('items', []):
             if item.get('one_click_unsub'):
                 one_click_count += 1
                 continue  # Can't undo one-click unsubs
 
-            try:
-                # Revert label changes
-                service.users().messages().modify(
-                    userId='me',
-                    id=item['message_id'],
-                    body={
-                        'addLabelIds': item.get('removed_labels', []),
-                        'removeLabelIds': item.get('added_labels', [])
-                    }
-                ).execute()
-                reverted_count += 1
+            revert_key = (tuple(item.get('removed_labels', [])), tuple(item.get('added_labels', [])))
+            revert_groups[revert_key].append(item['message_id'])
 
-            except Exception as e:
-                logger.error(f"Failed to revert message {item['message_id']}: {e}")
+        for (add_labels, remove_labels), msg_ids in revert_groups.items():
+            if not add_labels and not remove_labels:
+                # Trashed messages carry no label change to revert
+                reverted_count += len(msg_ids)
+                continue
+            failed_ids = batch_modify_labels(service, msg_ids, list(add_labels), list(remove_labels))
+            reverted_count += len(msg_ids) - len(failed_ids)
 
         # Delete created filters
         deleted_filters = 0
@@ -1440,7 +1800,7 @@ def chat_with_gmail_context_endpoint():
         # Build context from current user session
         gmail_context = {
             "stats": user_stats.get(user_id, {}),
-            "recent_activities": user_activities.get(user_id, [])[-3:],
+            "recent_activities": list(user_activities.get(user_id, []))[-3:],
             "service": "gmail-unsubscriber"
         }
         
@@ -1534,6 +1894,43 @@ def chat_conversation_endpoint():
         logger.error(f"Error in Claude conversation: {e}")
         return jsonify({"error": "Internal server error"}), 500
 
+@app.route('/api/chat/stream', methods=['POST'])
+@auth_required
+def chat_stream_endpoint():
+    """Stream Claude's reply as server-sent events so the first tokens show up immediately."""
+    if not CLAUDE_AVAILABLE:
+        return jsonify({"error": "Claude chat not available"}), 503
+    
+    data = request.get_json() or {}
+    message = data.get('message', '').strip()
+    history = data.get('history', [])
+    
+    if not message:
+        return jsonify({"error": "Message is required"}), 400
+    
+    # Validate history format
+    if history and not isinstance(history, list):
+        return jsonify({"error": "History must be a list of message objects"}), 400
+    
+    user_id = g.user_id
+    logger.info(f"Claude streaming chat from user {user_id} with {len(history)} history items")
+    
+    def generate():
+        try:
+            for text in chat_stream(message, history):
+                yield f"data: {json.dumps({'text': text})}\n\n"
+            yield "event: done\ndata: {}\n\n"
+        except Exception as e:
+            # Headers are already sent, so report the failure in-band
+            logger.error(f"Error in Claude streaming chat: {e}")
+            yield f"event: error\ndata: {json.dumps({'error': 'Internal server error'})}\n\n"
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
 # Helper functions
 def get_user_info(credentials):
     """Get the user's email address from their Google account."""
@@ -1545,11 +1942,10 @@ def get_user_info(credentials):
         oauth_logger.debug(f"Has refresh token: {bool(credentials.refresh_token)}")
         
         # Refresh credentials if needed
-        from google.auth.transport.requests import Request as AuthRequest
         if not credentials.valid:
             if credentials.expired and credentials.refresh_token:
                 oauth_logger.info("Refreshing expired credentials")
-                credentials.refresh(AuthRequest())
+                credentials.refresh(Request(session=google_session))
         
         # Log token information for debugging
         oauth_logger.debug(f"Token value: {getattr(credentials, 'token', 'NO TOKEN ATTR')[:20]}..." if hasattr(credentials, 'token') and credentials.token else "NO TOKEN")
@@ -1577,7 +1973,6 @@ def get_user_info(credentials):
             
             # Option 2: Fallback to manual request with proper token access
             oauth_logger.info("Falling back to manual HTTP request")
-            import requests as req
             
             # Try different ways to access the token
             access_token = None
@@ -1596,7 +1991,7 @@ def get_user_info(credentials):
                 raise ValueError("Could not find access token in credentials object")
             
             headers = {'Authorization': f'Bearer {access_token}'}
-            response = req.get('https://www.googleapis.com/oauth2/v2/userinfo', headers=headers)
+            response = google_session.get('https://www.googleapis.com/oauth2/v2/userinfo', headers=headers, timeout=10)
             
             if response.status_code != 200:
                 raise ValueError(f"Failed to get user info: {response.status_code} - {response.text}")
@@ -1617,9 +2012,6 @@ def get_user_info(credentials):
 
 def add_activity(user_id, activity_type, message, metadata=None):
     """Add an activity to the user's activity log."""
-    if user_id not in user_activities:
-        user_activities[user_id] = []
-    
     activity = {
         "type": activity_type,
         "message": message,
@@ -1630,11 +2022,10 @@ def add_activity(user_id, activity_type, message, metadata=None):
     if metadata:
         activity["metadata"] = metadata
     
-    user_activities[user_id].insert(0, activity)
-    
-    # Limit to 50 most recent activities
-    if len(user_activities[user_id]) > 50:
-        user_activities[user_id] = user_activities[user_id][:50]
+    # The deque drops the oldest entry once MAX_ACTIVITIES_PER_USER is reached
+    user_activities.setdefault(
+        user_id, deque(maxlen=MAX_ACTIVITIES_PER_USER)
+    ).appendleft(activity)
     
     # Save to database
     save_activity_to_db(user_id, activity)
@@ -1727,6 +2118,17 @@ def invalidate_stats_cache(user_id):
         del stats_cache[user_id]
         logger.debug(f"Invalidated stats cache for user {user_id}")
 
+def add_domain_email(domain_stats, email):
+    """Record a sender address for a domain's stats.
+
+    Stats loaded from the database hold the addresses as a sorted tuple;
+    it is turned into a set the first time an address is added.
+    """
+    emails = domain_stats["emails"]
+    if not isinstance(emails, set):
+        emails = domain_stats["emails"] = set(emails)
+    emails.add(email)
+
 def calculate_time_saved(total_unsubscribed):
     """
     Calculate time saved based on realistic email processing time.
@@ -1788,8 +2190,56 @@ def ensure_label_exists(service, label_name):
         # Return None if we can't create the label, we'll handle this gracefully
         return None
 
-def process_unsubscriptions(user_id, query, max_emails, creds_data):
-    """Process unsubscriptions for the user."""
+def batch_modify_labels(service, msg_ids, add_label_ids, remove_label_ids, gmail_bucket=None):
+    """Apply one label change to many messages with messages.batchModify.
+
+    Sends one request per GMAIL_BATCH_MODIFY_MAX_IDS messages instead of one
+    modify call each. Failures are logged, not raised.
+
+    Returns:
+        list: IDs of the messages whose batch failed
+    """
+    failed_ids = []
+    for start in range(0, len(msg_ids), GMAIL_BATCH_MODIFY_MAX_IDS):
+        batch_ids = msg_ids[start:start + GMAIL_BATCH_MODIFY_MAX_IDS]
+        try:
+            if gmail_bucket:
+                gmail_bucket.acquire(GMAIL_BATCH_MODIFY_COST)
+            service.users().messages().batchModify(
+                userId='me',
+                body={
+                    'ids': batch_ids,
+                    'addLabelIds': add_label_ids,
+                    'removeLabelIds': remove_label_ids
+                }
+            ).execute()
+        except Exception as e:
+            logger.error(f"Failed to modify labels on {len(batch_ids)} messages: {e}")
+            failed_ids.extend(batch_ids)
+    return failed_ids
+
+def run_unsubscription_scan(operation_id, user_id, query, max_emails, credentials, label_ids=None):
+    """Background worker for the unsubscription scan started by /api/unsubscribe/start."""
+    try:
+        logger.info(f"Starting unsubscription scan {operation_id} for user {user_id}")
+        process_unsubscriptions(user_id, query, max_emails, credentials, operation_id, label_ids)
+        update_operation_status(operation_id, {'status': 'completed'})
+        logger.info(f"Completed unsubscription scan {operation_id}")
+    except Exception as e:
+        logger.error(f"Error in unsubscription process: {e}")
+        add_activity(user_id, "error", f"Error in unsubscription process: {str(e)}")
+        update_operation_status(operation_id, {
+            'status': 'error',
+            'error': str(e)
+        })
+
+def process_unsubscriptions(user_id, query, max_emails, credentials, operation_id=None, label_ids=None):
+    """Process unsubscriptions for the user.
+
+    When operation_id is given, per-email progress is published through
+    update_operation_status for the status endpoint to poll. label_ids
+    optionally restricts the search to Gmail labels/categories.
+    """
     
     # Initialize user stats if not exists
     if user_id not in user_stats:
@@ -1811,20 +2261,13 @@ def process_unsubscriptions(user_id, query, max_emails, creds_data):
     
     # Initialize user activities if not exists
     if user_id not in user_activities:
-        user_activities[user_id] = []
+        user_activities[user_id] = deque(maxlen=MAX_ACTIVITIES_PER_USER)
         logger.info(f"Initialized activities for user: {user_id}")
     else:
         logger.info(f"Using existing activities for user: {user_id} (count: {len(user_activities[user_id])})")
     
-    creds = Credentials.from_authorized_user_info(creds_data, SCOPES)
-    if not creds.valid and creds.refresh_token:
-        try:
-            creds.refresh(Request())
-            creds_data.update(json.loads(creds.to_json()))
-        except Exception as e:
-            logger.error(f"Error refreshing credentials: {e}")
-            raise
-    service = build(API_SERVICE_NAME, API_VERSION, credentials=creds)
+    service = build(API_SERVICE_NAME, API_VERSION, credentials=copy_user_credentials(user_id, credentials))
+    gmail_bucket = get_gmail_bucket(user_id)
     
     # Ensure the UNSUBSCRIBED label exists
     add_activity(user_id, "info", "Setting up Gmail labels...")
@@ -1836,7 +2279,7 @@ def process_unsubscriptions(user_id, query, max_emails, creds_data):
     
     # Search for emails
     add_activity(user_id, "info", "Searching for subscription emails...")
-    messages = search_emails(service, query, max_emails)
+    messages = search_emails(service, query, max_emails, label_ids)
     
     if not messages:
         add_activity(user_id, "warning", "No subscription emails found")
@@ -1847,73 +2290,159 @@ def process_unsubscriptions(user_id, query, max_emails, creds_data):
     # Process each email with individual error boundaries
     successful_count = 0
     failed_count = 0
+    done_senders = set()  # Sender addresses unsubscribed during this run
+    done_links = set()  # Normalized unsubscribe links that succeeded during this run
+    failed_links = set()  # Normalized links that already failed during this run
+
+    def label_as_unsubscribed(msg_id):
+        """Add the UNSUBSCRIBED label and archive the email (with error boundary)."""
+        if not unsubscribed_label_id:
+            return
+        try:
+            gmail_bucket.acquire(GMAIL_MODIFY_COST)
+            service.users().messages().modify(
+                userId='me',
+                id=msg_id,
+                body={'removeLabelIds': ['INBOX'], 'addLabelIds': [unsubscribed_label_id]}
+            ).execute()
+            logger.info(f"Successfully labeled email {msg_id} as UNSUBSCRIBED")
+        except Exception as label_error:
+            logger.warning(f"Failed to label email {msg_id}: {str(label_error)}")
+            # Continue processing even if labeling fails
     
     for i, msg in enumerate(messages):
         msg_id = msg.get('id', 'unknown')
         
         try:
             logger.info(f"Processing email {i+1}/{len(messages)}: {msg_id}")
+            if operation_id:
+                update_operation_status(operation_id, {
+                    'progress': {
+                        'processed': i,
+                        'total': len(messages),
+                        'current_email_info': {'message': f"Processing email {i+1}/{len(messages)}..."}
+                    }
+                })
             logger.debug(f"user_id: {user_id}")
             logger.debug(f"user_stats keys: {list(user_stats.keys())}")
             logger.debug(f"user_id in user_stats: {user_id in user_stats}")
             
-            # Step 1: Get email content (with error boundary)
+            # Step 1: Get email headers (with error boundary)
             email_data = {"content": "", "metadata": {}}
             try:
-                email_data = get_email(service, msg_id)
-                if not email_data.get("content"):
-                    logger.warning(f"No content retrieved for email {msg_id}")
-                    metadata = email_data.get("metadata", {})
-                    sender_info = metadata.get("sender_name", "Unknown sender")
-                    add_activity(user_id, "warning", f"No content found in email {i+1}/{len(messages)} from {sender_info}", metadata)
-                    user_stats[user_id]["total_scanned"] += 1
-                    save_stats_to_db(user_id)
-                    failed_count += 1
-                    continue
-            except Exception as content_error:
-                logger.error(f"Failed to get content for email {msg_id}: {str(content_error)}")
+                gmail_bucket.acquire(GMAIL_GET_COST)
+                message = service.users().messages().get(
+                    userId='me',
+                    id=msg_id,
+                    format='metadata',
+                    metadataHeaders=UNSUB_METADATA_HEADERS
+                ).execute()
+                email_data["metadata"] = extract_email_metadata(message)
+            except Exception as header_error:
+                logger.error(f"Failed to get headers for email {msg_id}: {str(header_error)}")
                 add_activity(user_id, "error", f"Failed to retrieve email {i+1}/{len(messages)}")
                 failed_count += 1
                 continue
             
-            # Step 2: Extract unsubscribe links (with error boundary)
-            unsub_links = []
-            metadata = email_data.get("metadata", {})
+            metadata = email_data["metadata"]
             sender_info = metadata.get("sender_name", "Unknown sender")
-            email_content = email_data.get("content", "")
-            
-            try:
-                unsub_links = extract_unsub_links(email_content)
-                if not unsub_links:
-                    logger.debug(f"No unsubscribe links found in email {msg_id}")
-                    add_activity(user_id, "warning", f"No unsubscribe links found in email {i+1}/{len(messages)} from {sender_info}", metadata)
-                    user_stats[user_id]["total_scanned"] += 1
-                    save_stats_to_db(user_id)
-                    failed_count += 1
-                    continue
-            except Exception as link_error:
-                logger.error(f"Failed to extract links from email {msg_id}: {str(link_error)}")
-                add_activity(user_id, "error", f"Failed to extract links from email {i+1}/{len(messages)} from {sender_info}", metadata)
-                user_stats[user_id]["total_scanned"] += 1
-                save_stats_to_db(user_id)
-                failed_count += 1
-                continue
-            
-            # Step 3: Try to unsubscribe (with error boundary)
+            sender_email = metadata.get("sender_email", "").lower()
+
+            # Shared sending domains (ESPs, newsletter platforms) carry many
+            # separate lists, so only the exact sender or list target counts
+            header_links = extract_unsub_from_headers(metadata)
+            list_targets = {normalize_unsub_link(link) for link in header_links}
+            if metadata.get("rfc8058_unsub_url"):
+                list_targets.add(normalize_unsub_link(metadata["rfc8058_unsub_url"]))
+            already_handled = bool(
+                (sender_email and sender_email in done_senders) or list_targets & done_links
+            )
             unsubscribed = False
-            try:
-                for link in unsub_links:
-                    if execute_unsub(link):
-                        unsubscribed = True
-                        break
-            except Exception as unsub_error:
-                logger.error(f"Failed to execute unsubscribe for email {msg_id}: {str(unsub_error)}")
-                add_activity(user_id, "error", f"Unsubscribe failed for email {i+1}/{len(messages)} from {sender_info}", metadata)
+
+            if not already_handled:
+                # Step 2: Try the List-Unsubscribe header first (with error boundary)
+                try:
+                    if metadata.get("has_rfc8058_one_click"):
+                        unsubscribed = execute_rfc8058_unsub(metadata["rfc8058_unsub_url"])
+                    if not unsubscribed:
+                        for link in header_links:
+                            if execute_unsub_cached(user_id, link, failed_links):
+                                unsubscribed = True
+                                break
+                except Exception as header_unsub_error:
+                    logger.warning(f"Header unsubscribe failed for email {msg_id}: {str(header_unsub_error)}")
+
+                if unsubscribed:
+                    logger.info(f"Unsubscribed from {sender_info} via List-Unsubscribe header")
+                else:
+                    # Step 3: Fall back to the HTML body (with error boundary)
+                    try:
+                        gmail_bucket.acquire(GMAIL_GET_COST)
+                        email_data = get_email(service, msg_id)
+                        email_content = email_data.get("content", "")
+                        if not email_content:
+                            logger.warning(f"No content retrieved for email {msg_id}")
+                            add_activity(user_id, "warning", f"No content found in email {i+1}/{len(messages)} from {sender_info}", metadata)
+                            user_stats[user_id]["total_scanned"] += 1
+                            save_stats_to_db(user_id)
+                            failed_count += 1
+                            continue
+                    except Exception as content_error:
+                        logger.error(f"Failed to get content for email {msg_id}: {str(content_error)}")
+                        add_activity(user_id, "error", f"Failed to retrieve email {i+1}/{len(messages)}")
+                        failed_count += 1
+                        continue
+
+                    unsub_links = []
+                    try:
+                        unsub_links = extract_unsub_links(email_content)
+                        if not unsub_links:
+                            logger.debug(f"No unsubscribe links found in email {msg_id}")
+                            add_activity(user_id, "warning", f"No unsubscribe links found in email {i+1}/{len(messages)} from {sender_info}", metadata)
+                            user_stats[user_id]["total_scanned"] += 1
+                            save_stats_to_db(user_id)
+                            failed_count += 1
+                            continue
+                    except Exception as link_error:
+                        logger.error(f"Failed to extract links from email {msg_id}: {str(link_error)}")
+                        add_activity(user_id, "error", f"Failed to extract links from email {i+1}/{len(messages)} from {sender_info}", metadata)
+                        user_stats[user_id]["total_scanned"] += 1
+                        save_stats_to_db(user_id)
+                        failed_count += 1
+                        continue
+
+                    try:
+                        for link in unsub_links:
+                            if normalize_unsub_link(link) in done_links:
+                                already_handled = True
+                                break
+                            if execute_unsub_cached(user_id, link, failed_links):
+                                unsubscribed = True
+                                list_targets.add(normalize_unsub_link(link))
+                                break
+                    except Exception as unsub_error:
+                        logger.error(f"Failed to execute unsubscribe for email {msg_id}: {str(unsub_error)}")
+                        add_activity(user_id, "error", f"Unsubscribe failed for email {i+1}/{len(messages)} from {sender_info}", metadata)
+                        user_stats[user_id]["total_scanned"] += 1
+                        save_stats_to_db(user_id)
+                        failed_count += 1
+                        continue
+
+            if already_handled:
+                # Same sender or list as an earlier email in this run: label and
+                # archive it like the first one, but it is not a new unsubscribe
+                logger.info(f"Skipping unsubscribe for {msg_id}: already unsubscribed from {sender_info} in this run")
                 user_stats[user_id]["total_scanned"] += 1
                 save_stats_to_db(user_id)
-                failed_count += 1
+                label_as_unsubscribed(msg_id)
+                add_activity(user_id, "info", f"Already unsubscribed from {sender_info} earlier in this run", metadata)
                 continue
-            
+
+            if unsubscribed:
+                if sender_email:
+                    done_senders.add(sender_email)
+                done_links.update(list_targets)
+
             # Step 4: Update stats and labels
             try:
                 user_stats[user_id]["total_scanned"] += 1
@@ -1938,7 +2467,7 @@ def process_unsubscriptions(user_id, query, max_emails, creds_data):
                             }
                         user_stats[user_id]["domains_unsubscribed"][domain]["count"] += 1
                         if metadata.get("sender_email"):
-                            user_stats[user_id]["domains_unsubscribed"][domain]["emails"].add(metadata.get("sender_email"))
+                            add_domain_email(user_stats[user_id]["domains_unsubscribed"][domain], metadata.get("sender_email"))
 
                     # Calculate time saved using the new realistic formula
                     user_stats[user_id]["time_saved"] = calculate_time_saved(user_stats[user_id]["total_unsubscribed"])
@@ -1952,18 +2481,8 @@ def process_unsubscriptions(user_id, query, max_emails, creds_data):
                     logger.error(f"Error updating unsubscribe stats for user {user_id}: {str(unsub_stats_error)}")
                     raise
                 
-                # Step 5: Add label to email (with error boundary)
-                if unsubscribed_label_id:
-                    try:
-                        service.users().messages().modify(
-                            userId='me',
-                            id=msg_id,
-                            body={'removeLabelIds': ['INBOX'], 'addLabelIds': [unsubscribed_label_id]}
-                        ).execute()
-                        logger.info(f"Successfully labeled email {msg_id} as UNSUBSCRIBED")
-                    except Exception as label_error:
-                        logger.warning(f"Failed to label email {msg_id}: {str(label_error)}")
-                        # Continue processing even if labeling fails
+                # Step 5: Add label to email
+                label_as_unsubscribed(msg_id)
                 
                 add_activity(user_id, "success", f"Successfully unsubscribed from {sender_info} ({metadata.get('sender_email', '')})", metadata)
                 successful_count += 1
@@ -1971,9 +2490,6 @@ def process_unsubscriptions(user_id, query, max_emails, creds_data):
                 add_activity(user_id, "error", f"Failed to unsubscribe from {sender_info} ({metadata.get('sender_email', '')})", metadata)
                 failed_count += 1
             
-            # Rate limiting
-            time.sleep(2)
-            
         except Exception as e:
             # This is a catch-all for any unexpected errors
             error_msg = f"Unexpected error processing email {msg_id}"
@@ -2008,17 +2524,48 @@ def process_unsubscriptions(user_id, query, max_emails, creds_data):
     total_processed = successful_count + failed_count
     add_activity(user_id, "success", f"Process completed. Processed {total_processed} emails: {successful_count} successful, {failed_count} failed.")
 
-def search_emails(service, query, max_results=50):
-    """Search Gmail for emails matching the query."""
-    results = service.users().messages().list(userId='me', q=query, maxResults=max_results).execute()
-    messages = results.get('messages', [])
-    return messages
+def search_emails(service, query, max_results=50, label_ids=None):
+    """Search Gmail for emails matching the query.
+
+    Pages through messages.list (Gmail caps a page at 500 ids), skips spam
+    and trash, and only asks for message ids. label_ids optionally narrows
+    the search to label/category indexes such as CATEGORY_PROMOTIONS.
+    """
+    messages = []
+    page_token = None
+
+    while len(messages) < max_results:
+        list_kwargs = {
+            'userId': 'me',
+            'q': query,
+            'maxResults': min(max_results - len(messages), GMAIL_LIST_PAGE_SIZE),
+            'includeSpamTrash': False,
+            'fields': 'messages/id,nextPageToken'
+        }
+        if label_ids:
+            list_kwargs['labelIds'] = label_ids
+        if page_token:
+            list_kwargs['pageToken'] = page_token
+
+        results = service.users().messages().list(**list_kwargs).execute()
+        messages.extend(results.get('messages', []))
+
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            break
+
+    return messages[:max_results]
 
 def get_email(service, msg_id):
     """Get the HTML content and metadata of an email with enhanced error handling."""
     try:
         logger.debug(f"Fetching email content for message ID: {msg_id}")
-        message = service.users().messages().get(userId='me', id=msg_id, format='full').execute()
+        message = service.users().messages().get(
+            userId='me',
+            id=msg_id,
+            format='full',
+            fields=EMAIL_CONTENT_FIELDS
+        ).execute()
         
         if not message:
             logger.warning(f"No message returned for ID: {msg_id}")
@@ -2048,6 +2595,20 @@ def get_email(service, msg_id):
         # Don't re-raise the exception, return empty content to allow processing to continue
         return {"content": "", "metadata": {}}
 
+def decode_body_data(data):
+    """Decode a base64url-encoded Gmail body part into text.
+
+    Uses pybase64 when installed, otherwise calls the C-level binascii
+    decoder directly instead of going through base64.urlsafe_b64decode.
+    Restores the padding Gmail strips.
+    """
+    padded = data + '=' * (-len(data) % 4)
+    if pybase64 is not None:
+        raw = pybase64.b64decode(padded, altchars=b'-_')
+    else:
+        raw = binascii.a2b_base64(padded.translate(_B64_URLSAFE_TRANS))
+    return raw.decode('utf-8', errors='replace')
+
 def extract_html_content(payload, msg_id):
     """Extract HTML content from email payload."""
     try:
@@ -2058,7 +2619,7 @@ def extract_html_content(payload, msg_id):
             for part in parts:
                 if part.get('mimeType') == 'text/html':
                     if 'data' in part.get('body', {}):
-                        data = base64.urlsafe_b64decode(part['body']['data']).decode('utf-8')
+                        data = decode_body_data(part['body']['data'])
                         return data
                 # Check nested parts (for complex multipart messages)
                 elif part.get('parts'):
@@ -2069,7 +2630,7 @@ def extract_html_content(payload, msg_id):
             # Single part message
             if payload.get('mimeType') == 'text/html':
                 if 'data' in payload.get('body', {}):
-                    data = base64.urlsafe_b64decode(payload['body']['data']).decode('utf-8')
+                    data = decode_body_data(payload['body']['data'])
                     return data
         
         return ""
@@ -2088,7 +2649,7 @@ def extract_text_content(payload, msg_id):
             for part in parts:
                 if part.get('mimeType') == 'text/plain':
                     if 'data' in part.get('body', {}):
-                        data = base64.urlsafe_b64decode(part['body']['data']).decode('utf-8')
+                        data = decode_body_data(part['body']['data'])
                         return data
                 # Check nested parts
                 elif part.get('parts'):
@@ -2099,7 +2660,7 @@ def extract_text_content(payload, msg_id):
             # Single part message
             if payload.get('mimeType') == 'text/plain':
                 if 'data' in payload.get('body', {}):
-                    data = base64.urlsafe_b64decode(payload['body']['data']).decode('utf-8')
+                    data = decode_body_data(payload['body']['data'])
                     return data
         
         return ""
@@ -2108,6 +2669,11 @@ def extract_text_content(payload, msg_id):
         logger.error(f"Error extracting text content from {msg_id}: {str(e)}")
         return ""
 
+@lru_cache(maxsize=4096)
+def _domain_display(domain):
+    """Make a domain more readable: amazon.com -> Amazon."""
+    return domain.split('.', 1)[0].capitalize()
+
 def extract_email_metadata(message):
     """Extract metadata from email headers including RFC 8058 detection."""
     try:
@@ -2124,64 +2690,44 @@ def extract_email_metadata(message):
             "rfc8058_unsub_url": ""
         }
 
-        # Get headers from the email
-        headers = message.get('payload', {}).get('headers', [])
-
-        for header in headers:
-            name = header.get('name', '').lower()
-            value = header.get('value', '')
-
-            if name == 'from':
-                metadata['sender'] = value
-                # Parse sender name and email
-                # Format can be: "Name <email@domain.com>" or just "email@domain.com"
-                import re
-                match = re.match(r'^"?([^"<]*)"?\s*<?([^>]+)>?$', value.strip())
-                if match:
-                    sender_name = match.group(1).strip()
-                    sender_email = match.group(2).strip()
-                    metadata['sender_name'] = sender_name if sender_name else sender_email.split('@')[0]
-                    metadata['sender_email'] = sender_email
-                    # Extract domain
-                    if '@' in sender_email:
-                        metadata['domain'] = sender_email.split('@')[1].lower()
-                else:
-                    # Fallback: treat entire value as email
-                    metadata['sender_email'] = value.strip()
-                    if '@' in value:
-                        metadata['domain'] = value.split('@')[1].lower()
-                        metadata['sender_name'] = value.split('@')[0]
-
-            elif name == 'subject':
-                metadata['subject'] = value
-
-            elif name == 'date':
-                metadata['date'] = value
-
-            elif name == 'list-unsubscribe':
-                metadata['list_unsubscribe'] = value
+        # Index headers once by lowercase name instead of scanning per field
+        headers = {
+            header.get('name', '').lower(): header.get('value', '')
+            for header in message.get('payload', {}).get('headers', [])
+        }
 
-            elif name == 'list-unsubscribe-post':
-                metadata['list_unsubscribe_post'] = value
+        value = headers.get('from', '')
+        if value:
+            metadata['sender'] = value
+            # Parse sender name and email
+            # Format can be: "Name <email@domain.com>" or just "email@domain.com"
+            sender_name, sender_email = parseaddr(value)
+            sender_email = sender_email or value.strip()
+            local, at, domain = sender_email.rpartition('@')
+            metadata['sender_name'] = sender_name or (local if at else domain)
+            metadata['sender_email'] = sender_email
+            # Extract domain
+            if at:
+                metadata['domain'] = domain.lower()
+
+        metadata['subject'] = headers.get('subject', '')
+        metadata['date'] = headers.get('date', '')
+        metadata['list_unsubscribe'] = headers.get('list-unsubscribe', '')
+        metadata['list_unsubscribe_post'] = headers.get('list-unsubscribe-post', '')
 
         # Clean up sender name - remove quotes, extra spaces
         metadata['sender_name'] = metadata['sender_name'].strip('"\'').strip()
 
         # If no sender name, use the domain as a fallback
         if not metadata['sender_name'] and metadata['domain']:
-            # Make domain more readable: amazon.com -> Amazon
-            domain_parts = metadata['domain'].split('.')
-            if domain_parts:
-                metadata['sender_name'] = domain_parts[0].capitalize()
+            metadata['sender_name'] = _domain_display(metadata['domain'])
 
         # RFC 8058 detection
         if metadata['list_unsubscribe'] and metadata['list_unsubscribe_post']:
             # Check if List-Unsubscribe-Post contains "List-Unsubscribe=One-Click"
             if 'list-unsubscribe=one-click' in metadata['list_unsubscribe_post'].lower():
                 # Extract HTTPS URL from List-Unsubscribe header
-                import re
-                # List-Unsubscribe can contain multiple URLs in angle brackets
-                url_matches = re.findall(r'<(https://[^>]+)>', metadata['list_unsubscribe'])
+                url_matches = [url for url in extract_unsub_from_headers(metadata) if url.startswith('https://')]
                 if url_matches:
                     # Use the first HTTPS URL found
                     metadata['has_rfc8058_one_click'] = True
@@ -2205,28 +2751,62 @@ def extract_email_metadata(message):
             "rfc8058_unsub_url": ""
         }
 
+def extract_unsub_from_headers(metadata):
+    """Extract HTTP(S) unsubscribe URLs from the List-Unsubscribe header."""
+    list_unsubscribe = metadata.get('list_unsubscribe', '')
+    if not list_unsubscribe:
+        return []
+
+    # List-Unsubscribe can contain multiple URLs in angle brackets, e.g.
+    # <https://example.com/unsub?id=1>, <mailto:unsub@example.com>
+    return _LIST_UNSUB_URL_RE.findall(list_unsubscribe)
+
+def _extract_unsub_links_lxml(html):
+    """Extract unsubscribe links in a single lxml pass over the anchors.
+
+    Raises lxml's parser errors (e.g. for strings carrying an XML encoding
+    declaration) so the caller can fall back to BeautifulSoup.
+    """
+    anchors = [(a.get('href'), a) for a in lxml.html.fromstring(html).iter('a') if a.get('href')]
+    links = [href for href, _ in anchors if _UNSUB_RE.search(href)]
+    if not links:
+        # The unsubscribe wording is only in the link text
+        links = [href for href, a in anchors if _UNSUB_RE.search(' '.join(a.itertext()))]
+    # Header, footer and alt-text often repeat the same link
+    return list(dict.fromkeys(links))
+
 def extract_unsub_links(html):
     """Extract unsubscribe links from HTML content."""
     if not html:
         return []
     
+    if lxml is not None:
+        try:
+            return _extract_unsub_links_lxml(html)
+        except Exception as e:
+            logger.debug(f"lxml could not parse email HTML, falling back to BeautifulSoup: {e}")
+    
     try:
-        soup = BeautifulSoup(html, 'html.parser')
-        links = []
-        pattern = re.compile(r'unsubscribe|opt[-\s]?out|email preferences', re.I)
-        
+        soup = BeautifulSoup(html, HTML_PARSER)
+
+        # Fast path: let BeautifulSoup match the href attribute against the
+        # pattern, so anchors without a matching href never reach Python code
+        links = [link['href'] for link in soup.find_all('a', href=_UNSUB_RE)]
+        if links:
+            # Header, footer and alt-text often repeat the same link
+            return list(dict.fromkeys(links))
+
+        # Slow path: the unsubscribe wording is only in the link text
         for link in soup.find_all('a', href=True):
             try:
-                link_text = link.text or ""
-                link_href = link.get('href', '')
-                
-                if link_href and (pattern.search(link_text) or pattern.search(link_href)):
+                link_href = link['href']
+                if link_href and _UNSUB_RE.search(link.get_text(' ', strip=True)):
                     links.append(link_href)
             except Exception as link_error:
                 logger.warning(f"Error processing individual link: {str(link_error)}")
                 continue
         
-        return links
+        return list(dict.fromkeys(links))
         
     except Exception as e:
         logger.error(f"Error extracting unsubscribe links: {type(e).__name__} - {str(e)}")
@@ -2235,7 +2815,8 @@ def extract_unsub_links(html):
 def execute_unsub(link):
     """Execute an unsubscription by visiting the link."""
     try:
-        response = requests.get(link, timeout=10)
+        get_unsub_bucket(link).acquire()
+        response = unsub_session.get(link, timeout=(3, 7), allow_redirects=True)
         if response.status_code == 200:
             logger.info(f'Successful GET unsubscribe: {link}')
             return True
@@ -2246,6 +2827,52 @@ def execute_unsub(link):
 
     return False
 
+def normalize_unsub_link(link):
+    """Normalize an unsubscribe link for duplicate detection.
+
+    Scheme and host are case-insensitive and the fragment never reaches the
+    server. The query string is kept because ESPs identify the list there.
+    """
+    parts = urlsplit(link.strip())
+    return parts._replace(
+        scheme=parts.scheme.lower(),
+        netloc=parts.netloc.lower(),
+        fragment=''
+    ).geturl()
+
+def execute_unsub_cached(user_id, link, failed_links=None):
+    """Execute an unsubscription unless the same link was already tried.
+
+    Successful links are remembered per user in unsub_success_cache, so one
+    user's success never stands in for a request on another user's behalf.
+    Failed links are remembered in the caller's failed_links set (one scan)
+    so they are not retried for every email that repeats them.
+    """
+    normalized_link = normalize_unsub_link(link)
+    cache_key = (user_id, normalized_link)
+
+    with unsub_cache_lock:
+        if cache_key in unsub_success_cache:
+            unsub_success_cache.move_to_end(cache_key)
+            logger.info(f'Unsubscribe link already handled, skipping request: {link}')
+            return True
+
+    if failed_links is not None and normalized_link in failed_links:
+        logger.debug(f'Unsubscribe link already failed in this run, skipping: {link}')
+        return False
+
+    if not execute_unsub(link):
+        if failed_links is not None:
+            failed_links.add(normalized_link)
+        return False
+
+    with unsub_cache_lock:
+        unsub_success_cache[cache_key] = True
+        if len(unsub_success_cache) > UNSUB_CACHE_MAX_ENTRIES:
+            unsub_success_cache.popitem(last=False)
+
+    return True
+
 def execute_rfc8058_unsub(url):
     """Execute RFC 8058 one-click unsubscribe via HTTP POST.
 
@@ -2257,14 +2884,12 @@ def execute_rfc8058_unsub(url):
     """
     try:
         # RFC 8058 requires POST with specific body
-        response = requests.post(
+        get_unsub_bucket(url).acquire()
+        response = unsub_session.post(
             url,
             data={'List-Unsubscribe': 'One-Click'},
-            timeout=10,
-            headers={
-                'Content-Type': 'application/x-www-form-urlencoded',
-                'User-Agent': 'Gmail-Unsubscriber/1.0'
-            }
+            timeout=(3, 7),
+            headers={'Content-Type': 'application/x-www-form-urlencoded'}
         )
 
         if response.status_code in [200, 201, 202, 204]:
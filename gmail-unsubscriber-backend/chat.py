@@ -9,7 +9,8 @@ costs and improve response times.
 import os
 import pathlib
 import logging
-from typing import List, Dict, Any, Optional
+import functools
+from typing import List, Dict, Any, Iterator, Optional, Tuple
 import anthropic
 from dotenv import load_dotenv
 
@@ -19,23 +20,91 @@ load_dotenv()
 # Configure logging
 logger = logging.getLogger(__name__)
 
+# Project prompt shared by every Claude request
+CLAUDE_MD_PATH = pathlib.Path(__file__).parent.parent / "CLAUDE.md"
+
+@functools.lru_cache(maxsize=1)
+def _load_claude_prompt(path: str, mtime_ns: int) -> str:
+    """Read the project prompt. Cached per file modification time."""
+    prompt = pathlib.Path(path).read_text(encoding='utf-8')
+    logger.info(f"Loaded CLAUDE.md ({len(prompt)} characters)")
+    return prompt
+
+@functools.lru_cache(maxsize=4)
+def _system_block(prompt: str, cache_type: str) -> Dict[str, Any]:
+    """Cached system prompt block, built once per prompt text and cache type.
+
+    Every request reuses the same dict, so the system prompt is sent
+    byte-for-byte identical and keeps hitting Anthropic's prompt cache.
+    """
+    return {
+        "type": "text",
+        "text": prompt,
+        "cache_control": {"type": cache_type}
+    }
+
+def _log_usage(label: str, usage: Any) -> None:
+    """Log token and cache usage for monitoring."""
+    logger.info(
+        f"{label} - Input: {usage.input_tokens}, "
+        f"Output: {usage.output_tokens}, "
+        f"Cache Read: {getattr(usage, 'cache_read_input_tokens', 0)}, "
+        f"Cache Write: {getattr(usage, 'cache_creation_input_tokens', 0)}"
+    )
+
 class ClaudeChatManager:
     """Manages Claude AI interactions with efficient prompt caching."""
     
     def __init__(self):
-        """Initialize Claude client and load cached prompt."""
+        """Initialize Claude client and check the project prompt is present."""
         self.client = anthropic.Anthropic(
             api_key=os.environ.get('ANTHROPIC_API_KEY')
         )
         
-        # Load the project prompt from CLAUDE.md
-        claude_md_path = pathlib.Path(__file__).parent.parent / "CLAUDE.md"
-        if not claude_md_path.exists():
-            raise FileNotFoundError(f"CLAUDE.md not found at {claude_md_path}")
+        # Fail fast if the project prompt is missing
+        if not CLAUDE_MD_PATH.exists():
+            raise FileNotFoundError(f"CLAUDE.md not found at {CLAUDE_MD_PATH}")
+        
+    @property
+    def claude_prompt(self) -> str:
+        """Project prompt from CLAUDE.md, re-read only when the file changes."""
+        return _load_claude_prompt(str(CLAUDE_MD_PATH), CLAUDE_MD_PATH.stat().st_mtime_ns)
         
-        self.claude_prompt = claude_md_path.read_text(encoding='utf-8')
-        logger.info(f"Loaded CLAUDE.md ({len(self.claude_prompt)} characters)")
+    def _build_request(
+        self,
+        message: str,
+        history: Optional[List[Dict[str, Any]]],
+        cache_type: str
+    ) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+        """Build the cached system prompt and message list for a request."""
+        # Prepare system prompt with caching
+        system_messages = [_system_block(self.claude_prompt, cache_type)]
         
+        # Prepare conversation messages
+        messages = []
+        
+        # Add conversation history if provided
+        if history:
+            messages.extend(history)
+            
+            # Cache the last assistant response if available
+            if (history and 
+                history[-1].get("role") == "assistant" and
+                len(history) > 1):
+                
+                # Add cache control to the last assistant message
+                last_msg = messages[-1].copy()
+                last_msg["cache_control"] = {"type": cache_type}
+                messages[-1] = last_msg
+        
+        # Add current user message
+        messages.append({
+            "role": "user",
+            "content": message
+        })
+        
+        return system_messages, messages
+    
     def ask_claude(
         self, 
         message: str, 
@@ -65,37 +134,7 @@ class ClaudeChatManager:
             raise ValueError("ANTHROPIC_API_KEY environment variable not set")
         
         try:
-            # Prepare system prompt with caching
-            system_messages = [
-                {
-                    "type": "text",
-                    "text": self.claude_prompt,
-                    "cache_control": {"type": cache_type}
-                }
-            ]
-            
-            # Prepare conversation messages
-            messages = []
-            
-            # Add conversation history if provided
-            if history:
-                messages.extend(history)
-                
-                # Cache the last assistant response if available
-                if (history and 
-                    history[-1].get("role") == "assistant" and
-                    len(history) > 1):
-                    
-                    # Add cache control to the last assistant message
-                    last_msg = messages[-1].copy()
-                    last_msg["cache_control"] = {"type": cache_type}
-                    messages[-1] = last_msg
-            
-            # Add current user message
-            messages.append({
-                "role": "user",
-                "content": message
-            })
+            system_messages, messages = self._build_request(message, history, cache_type)
             
             # Make API call with caching
             response = self.client.messages.create(
@@ -106,13 +145,7 @@ class ClaudeChatManager:
             )
             
             # Log cache usage for monitoring
-            usage = response.usage
-            logger.info(
-                f"Claude API call - Input: {usage.input_tokens}, "
-                f"Output: {usage.output_tokens}, "
-                f"Cache Read: {getattr(usage, 'cache_read_input_tokens', 0)}, "
-                f"Cache Write: {getattr(usage, 'cache_creation_input_tokens', 0)}"
-            )
+            _log_usage("Claude API call", response.usage)
             
             return response
             
@@ -123,6 +156,52 @@ class ClaudeChatManager:
             logger.error(f"Unexpected error in Claude chat: {e}")
             raise
     
+    def ask_claude_stream(
+        self,
+        message: str,
+        history: Optional[List[Dict[str, Any]]] = None,
+        model: str = "claude-3-5-sonnet-20241022",
+        max_tokens: int = 1024,
+        cache_type: str = "ephemeral"
+    ) -> Iterator[str]:
+        """
+        Stream Claude's reply as text deltas, using the cached project prompt.
+        
+        Takes the same arguments as ask_claude. Prompt caching mostly shortens
+        the time to the first token, which streaming lets callers observe and
+        show to the user before the full reply is generated.
+        
+        Yields:
+            Text fragments of the response, in order
+            
+        Raises:
+            anthropic.APIError: If API call fails
+            ValueError: If required environment variables are missing
+        """
+        if not self.client.api_key:
+            raise ValueError("ANTHROPIC_API_KEY environment variable not set")
+        
+        try:
+            system_messages, messages = self._build_request(message, history, cache_type)
+            
+            with self.client.messages.stream(
+                model=model,
+                max_tokens=max_tokens,
+                system=system_messages,
+                messages=messages
+            ) as stream:
+                yield from stream.text_stream
+                
+                # Usage is only complete once the stream has finished
+                _log_usage("Claude streaming call", stream.get_final_message().usage)
+            
+        except anthropic.APIError as e:
+            logger.error(f"Anthropic API error: {e}")
+            raise
+        except Exception as e:
+            logger.error(f"Unexpected error in Claude chat stream: {e}")
+            raise
+    
     def chat_simple(self, message: str) -> str:
         """
         Simple chat interface that returns just the text response.
@@ -170,17 +249,23 @@ class ClaudeChatManager:
         
         return self.chat_simple(full_message)
 
-# Global instance for use across the application
-chat_manager = ClaudeChatManager()
+@functools.lru_cache(maxsize=1)
+def _get_chat_manager() -> ClaudeChatManager:
+    """Shared manager, created on first use so importing this module stays cheap."""
+    return ClaudeChatManager()
 
 # Convenience functions for easy import
 def ask_claude(message: str, history: Optional[List[Dict[str, Any]]] = None) -> anthropic.types.Message:
     """Convenience function to ask Claude with caching."""
-    return chat_manager.ask_claude(message, history)
+    return _get_chat_manager().ask_claude(message, history)
+
+def chat_stream(message: str, history: Optional[List[Dict[str, Any]]] = None) -> Iterator[str]:
+    """Convenience function to stream Claude's reply as text deltas."""
+    return _get_chat_manager().ask_claude_stream(message, history)
 
 def chat_simple(message: str) -> str:
     """Convenience function for simple text chat."""
-    return chat_manager.chat_simple(message)
+    return _get_chat_manager().chat_simple(message)
 
 def chat_with_gmail_context(
     message: str, 
@@ -188,4 +273,4 @@ def chat_with_gmail_context(
     user_context: Optional[Dict[str, Any]] = None
 ) -> str:
     """Convenience function for Gmail-context aware chat."""
-    return chat_manager.chat_with_context(message, gmail_context, user_context) 
\ No newline at end of file
+    return _get_chat_manager().chat_with_context(message, gmail_context, user_context) 
\ No newline at end of file
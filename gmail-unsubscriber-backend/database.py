@@ -4,23 +4,228 @@ Provides SQLite-based persistent storage for user statistics and activities.
 """
 
 import sqlite3
+import hashlib
 import json
 import logging
 import threading
 import os
+import time
+import queue
+from concurrent.futures import Future
 from contextlib import contextmanager
-from datetime import datetime
-from typing import Dict, List, Any, Optional, Tuple
+from datetime import datetime, timedelta, timezone
+from itertools import islice
+from typing import Dict, List, Any, Callable, Final, Iterable, Iterator, Optional, Tuple
+
+# orjson is much faster for the JSON columns; fall back to stdlib json.
+# Both loaders accept str or bytes and raise json.JSONDecodeError subclasses.
+try:
+    import orjson
+
+    json_dumps = orjson.dumps
+    json_loads = orjson.loads
+except ImportError:
+    def json_dumps(obj: Any) -> bytes:
+        return json.dumps(obj).encode('utf-8')
+
+    json_loads = json.loads
+
+# Operation payloads are stored as msgpack when it is installed and as JSON
+# bytes otherwise. A JSON object always starts with '{', which is never the
+# first byte of a msgpack map, so rows written either way stay readable.
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+def pack_payload(payload: Dict[str, Any]) -> bytes:
+    """Encode an operation payload for operations_history.payload."""
+    if msgpack is not None:
+        return msgpack.packb(payload, use_bin_type=True)
+    return json_dumps(payload)
+
+
+def unpack_payload(data: Any) -> Dict[str, Any]:
+    """Decode an operation payload written by pack_payload or as legacy JSON text."""
+    if isinstance(data, str) or data[:1] == b'{':
+        return json_loads(data)
+    if msgpack is None:
+        raise ValueError("Operation payload is msgpack-encoded but msgpack is not installed")
+    return msgpack.unpackb(data, raw=False)
 
 logger = logging.getLogger(__name__)
 
+# Activities kept per user, matching the in-memory limit in app.py
+MAX_ACTIVITIES_PER_USER = 50
+
+# How long load_user_stats / load_user_activities results are reused
+LOAD_CACHE_TTL_SECONDS = 30
+
+# Rows fetched per batch when the loaders scan whole tables
+LOAD_FETCH_SIZE = 1000
+
+# Activity types stored as small integer ids in user_activities.type_id, seeded
+# with fixed ids; any other type is added to activity_types when first saved
+ACTIVITY_TYPES: Final[Dict[str, int]] = {'info': 1, 'success': 2, 'warning': 3, 'error': 4}
+
+# Column definitions of the user-scoped tables. _rebuild_table migrates older
+# databases to these shapes; every table cascades deletes from users.
+_USER_STATS_SCHEMA: Final[str] = '''(
+    user_id TEXT PRIMARY KEY,
+    total_scanned INTEGER DEFAULT 0,
+    total_unsubscribed INTEGER DEFAULT 0,
+    time_saved INTEGER DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE
+)'''
+_USER_ACTIVITIES_SCHEMA: Final[str] = '''(
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    type_id INTEGER NOT NULL REFERENCES activity_types (id),
+    message TEXT NOT NULL,
+    metadata TEXT,
+    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    client_msg_id TEXT,
+    FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE
+)'''
+_DOMAINS_UNSUBSCRIBED_SCHEMA: Final[str] = '''(
+    user_id TEXT NOT NULL,
+    domain TEXT NOT NULL,
+    sender_name TEXT,
+    count INTEGER DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (user_id, domain),
+    FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE
+) WITHOUT ROWID'''
+_DOMAIN_EMAILS_SCHEMA: Final[str] = '''(
+    user_id TEXT NOT NULL,
+    domain TEXT NOT NULL,
+    email TEXT NOT NULL,
+    PRIMARY KEY (user_id, domain, email),
+    FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE
+) WITHOUT ROWID'''
+_OPERATIONS_HISTORY_SCHEMA: Final[str] = '''(
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    operation_id TEXT UNIQUE NOT NULL,
+    payload BLOB NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    undone INTEGER DEFAULT 0,
+    FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE
+)'''
+_STATS_HISTORY_SCHEMA: Final[str] = '''(
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    total_scanned INTEGER DEFAULT 0,
+    total_unsubscribed INTEGER DEFAULT 0,
+    time_saved INTEGER DEFAULT 0,
+    emails_deleted INTEGER DEFAULT 0,
+    recorded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE
+)'''
+
+# Hot statements live in module constants so every call sends the same SQL
+# text and hits the connection's prepared-statement cache
+_UPSERT_USER_SQL: Final[str] = '''
+    INSERT INTO users (user_id, email) VALUES (?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET last_active = CURRENT_TIMESTAMP
+'''
+_INSERT_USER_STATS_SQL: Final[str] = 'INSERT OR IGNORE INTO user_stats (user_id) VALUES (?)'
+_UPSERT_STATS_SQL: Final[str] = '''
+    INSERT INTO user_stats (user_id, total_scanned, total_unsubscribed, time_saved)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET
+        total_scanned = excluded.total_scanned,
+        total_unsubscribed = excluded.total_unsubscribed,
+        time_saved = excluded.time_saved,
+        updated_at = CURRENT_TIMESTAMP
+'''
+_UPSERT_DOMAIN_SQL: Final[str] = '''
+    INSERT INTO domains_unsubscribed (user_id, domain, sender_name, count)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT(user_id, domain) DO UPDATE SET
+        sender_name = excluded.sender_name,
+        count = excluded.count,
+        updated_at = CURRENT_TIMESTAMP
+'''
+_INSERT_DOMAIN_EMAIL_SQL: Final[str] = 'INSERT OR IGNORE INTO domain_emails (user_id, domain, email) VALUES (?, ?, ?)'
+_INSERT_ACTIVITY_TYPE_SQL: Final[str] = 'INSERT OR IGNORE INTO activity_types (name) VALUES (?)'
+_INSERT_ACTIVITY_SQL: Final[str] = '''
+    INSERT OR IGNORE INTO user_activities (user_id, type_id, message, metadata, timestamp, client_msg_id)
+    VALUES (?, (SELECT id FROM activity_types WHERE name = ?), ?, ?, ?, ?)
+'''
+_TRIM_ACTIVITIES_SQL: Final[str] = '''
+    DELETE FROM user_activities 
+    WHERE user_id = ? AND id IN (
+        SELECT id FROM user_activities 
+        WHERE user_id = ? 
+        ORDER BY timestamp DESC 
+        LIMIT -1 OFFSET ?
+    )
+'''
+_UPSERT_SNAPSHOT_SQL: Final[str] = '''
+    INSERT INTO stats_history
+    (user_id, total_scanned, total_unsubscribed, time_saved, emails_deleted)
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT (user_id, date(recorded_at)) DO UPDATE SET
+        total_scanned = MAX(stats_history.total_scanned, excluded.total_scanned),
+        total_unsubscribed = MAX(stats_history.total_unsubscribed, excluded.total_unsubscribed),
+        time_saved = MAX(stats_history.time_saved, excluded.time_saved),
+        emails_deleted = MAX(stats_history.emails_deleted, excluded.emails_deleted),
+        recorded_at = excluded.recorded_at
+    WHERE excluded.total_scanned > stats_history.total_scanned
+        OR excluded.total_unsubscribed > stats_history.total_unsubscribed
+        OR excluded.time_saved > stats_history.time_saved
+        OR excluded.emails_deleted > stats_history.emails_deleted
+'''
+_DELETE_ACTIVITIES_BEFORE_SQL: Final[str] = 'DELETE FROM user_activities WHERE timestamp < ? RETURNING user_id'
+_SELECT_OPERATION_SQL: Final[str] = '''
+    SELECT payload, undone
+    FROM operations_history
+    WHERE user_id = ? AND operation_id = ?
+'''
+
+_DATABASE_STATS_SQL: Final[str] = '''
+    SELECT
+        (SELECT COUNT(*) FROM users),
+        (SELECT COUNT(*) FROM user_activities),
+        (SELECT COUNT(*) FROM domains_unsubscribed),
+        (SELECT MAX(timestamp) FROM user_activities),
+        (SELECT page_count FROM pragma_page_count()) * (SELECT page_size FROM pragma_page_size())
+'''
+
+def _chunked(items: Iterable[Any], size: int) -> Iterator[List[Any]]:
+    """Yield lists of up to size items from an iterable."""
+    iterator = iter(items)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def activity_msg_id(activity_type: str, message: str, time: str) -> str:
+    """Stable identity of an activity, used to skip rows that are already stored."""
+    return hashlib.sha1(f"{activity_type}|{message}|{time}".encode('utf-8')).hexdigest()
+
 class DatabaseManager:
     """Manages SQLite database operations for Gmail Unsubscriber."""
     
-    def __init__(self, db_path: str = "gmail_unsubscriber.db"):
+    def __init__(self, db_path: str = "gmail_unsubscriber.db", pool_size: int = 4):
         """Initialize database manager with specified database path."""
         self.db_path = db_path
-        self.lock = threading.Lock()
+        self.pool_size = pool_size
+        # SQLite allows one writer at a time: every write runs on a single writer
+        # thread that owns the write connection, while readers use pooled
+        # connections without locking (WAL)
+        self._pool: Optional[queue.Queue] = None
+        self._write_queue: Optional[queue.Queue] = None
+        self._writer_thread: Optional[threading.Thread] = None
+        self._pool_pid: Optional[int] = None
+        self._pool_lock = threading.Lock()
+        self._load_cache: Dict[str, Tuple[float, Any]] = {}  # loader name -> (expires_at, result)
+        self._load_cache_version = 0
+        self._load_cache_lock = threading.Lock()
         self._ensure_db_directory()
         logger.info(f"Database manager initialized with path: {self.db_path}")
     
@@ -31,199 +236,431 @@ class DatabaseManager:
             os.makedirs(db_dir, exist_ok=True)
             logger.info(f"Created database directory: {db_dir}")
     
+    def _connect(self) -> sqlite3.Connection:
+        """Open a long-lived connection and apply the connection PRAGMAs once."""
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, cached_statements=256)
+        conn.row_factory = sqlite3.Row  # Enable row access by column name
+        # Enable WAL mode for better concurrency
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA cache_size=-64000')  # 64 MB page cache
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute('PRAGMA mmap_size=2147483648')
+        conn.execute('PRAGMA busy_timeout=5000')
+        conn.execute('PRAGMA foreign_keys=ON')
+        conn.execute('PRAGMA wal_autocheckpoint=1000')
+        return conn
+    
+    def _ensure_pool(self):
+        """Open the reader pool and start the writer thread on first use in this process.
+        
+        SQLite connections must not be shared across fork() (gunicorn --preload),
+        and threads do not survive it, so a pool created in another process is
+        replaced rather than reused.
+        """
+        pid = os.getpid()
+        if self._pool_pid == pid:
+            return
+        with self._pool_lock:
+            if self._pool_pid == pid:
+                return
+            pool = queue.Queue(maxsize=self.pool_size)
+            for _ in range(self.pool_size):
+                pool.put(self._connect())
+            write_queue = queue.Queue()
+            writer_thread = threading.Thread(
+                target=self._writer_loop, args=(self._connect(), write_queue),
+                name='db-writer', daemon=True
+            )
+            writer_thread.start()
+            self._pool = pool
+            self._write_queue = write_queue
+            self._writer_thread = writer_thread
+            self._pool_pid = pid
+            logger.info(f"Opened {self.pool_size} reader connections and 1 writer connection")
+    
+    def _writer_loop(self, conn: sqlite3.Connection, write_queue: queue.Queue):
+        """Run queued writes one at a time on the writer connection until close()."""
+        while True:
+            task = write_queue.get()
+            if task is None:
+                conn.close()
+                return
+            write, future = task
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(write(conn))
+            except BaseException as e:
+                conn.rollback()
+                logger.error(f"Database connection error: {e}")
+                future.set_exception(e)
+    
     @contextmanager
     def get_connection(self):
-        """Get a database connection with proper resource management."""
-        conn = None
+        """Check out a pooled reader connection, returning it to the pool afterwards."""
+        self._ensure_pool()
+        pool = self._pool
+        conn = pool.get()
         try:
-            conn = sqlite3.connect(self.db_path, timeout=30.0)
-            conn.row_factory = sqlite3.Row  # Enable row access by column name
-            # Enable WAL mode for better concurrency
-            conn.execute('PRAGMA journal_mode=WAL')
-            conn.execute('PRAGMA synchronous=NORMAL')
-            conn.execute('PRAGMA cache_size=10000')
             yield conn
         except Exception as e:
-            if conn:
-                conn.rollback()
+            conn.rollback()
             logger.error(f"Database connection error: {e}")
             raise
         finally:
-            if conn:
-                conn.close()
+            pool.put(conn)
+    
+    def _run_write(self, write: Callable[[sqlite3.Connection], Any]) -> Any:
+        """Run write(conn) on the writer thread and wait for its result.
+        
+        Exceptions raised by write are rolled back on the writer connection and
+        re-raised here.
+        """
+        self._ensure_pool()
+        future = Future()
+        self._write_queue.put((write, future))
+        return future.result()
+    
+    def close(self):
+        """Close all pooled connections. They are reopened on next use."""
+        with self._pool_lock:
+            if self._pool_pid == os.getpid():
+                while True:
+                    try:
+                        self._pool.get_nowait().close()
+                    except queue.Empty:
+                        break
+                # Writes already queued run before the writer closes its connection
+                self._write_queue.put(None)
+                self._writer_thread.join()
+            self._pool = None
+            self._write_queue = None
+            self._writer_thread = None
+            self._pool_pid = None
     
     def initialize_database(self) -> bool:
         """Initialize database with required tables. Returns True if successful."""
         try:
-            with self.lock:
-                with self.get_connection() as conn:
-                    # Create users table
-                    conn.execute('''
-                        CREATE TABLE IF NOT EXISTS users (
-                            user_id TEXT PRIMARY KEY,
-                            email TEXT UNIQUE NOT NULL,
-                            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                            last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                        )
-                    ''')
-                    
-                    # Create user_stats table
-                    conn.execute('''
-                        CREATE TABLE IF NOT EXISTS user_stats (
-                            user_id TEXT PRIMARY KEY,
-                            total_scanned INTEGER DEFAULT 0,
-                            total_unsubscribed INTEGER DEFAULT 0,
-                            time_saved INTEGER DEFAULT 0,
-                            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                            FOREIGN KEY (user_id) REFERENCES users (user_id)
-                        )
-                    ''')
-                    
-                    # Create user_activities table
-                    conn.execute('''
-                        CREATE TABLE IF NOT EXISTS user_activities (
-                            id INTEGER PRIMARY KEY AUTOINCREMENT,
-                            user_id TEXT NOT NULL,
-                            type TEXT NOT NULL,
-                            message TEXT NOT NULL,
-                            metadata TEXT,
-                            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                            FOREIGN KEY (user_id) REFERENCES users (user_id)
-                        )
-                    ''')
-                    
-                    # Create domains_unsubscribed table
-                    conn.execute('''
-                        CREATE TABLE IF NOT EXISTS domains_unsubscribed (
-                            user_id TEXT NOT NULL,
-                            domain TEXT NOT NULL,
-                            sender_name TEXT,
-                            count INTEGER DEFAULT 0,
-                            emails_json TEXT DEFAULT '[]',
-                            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                            PRIMARY KEY (user_id, domain),
-                            FOREIGN KEY (user_id) REFERENCES users (user_id)
-                        )
-                    ''')
-                    
-                    # Create operations_history table for undo functionality
+            def write(conn):
+                # Create users table
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS users (
+                        user_id TEXT PRIMARY KEY,
+                        email TEXT UNIQUE NOT NULL,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                ''')
+                
+                # Create user_stats table
+                conn.execute('CREATE TABLE IF NOT EXISTS user_stats ' + _USER_STATS_SCHEMA)
+                
+                # Create activity_types lookup table, referenced by user_activities.type_id
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS activity_types (
+                        id INTEGER PRIMARY KEY,
+                        name TEXT UNIQUE NOT NULL
+                    )
+                ''')
+                conn.executemany(
+                    'INSERT OR IGNORE INTO activity_types (id, name) VALUES (?, ?)',
+                    [(type_id, name) for name, type_id in ACTIVITY_TYPES.items()]
+                )
+                
+                # Create user_activities table
+                conn.execute('CREATE TABLE IF NOT EXISTS user_activities ' + _USER_ACTIVITIES_SCHEMA)
+                self._migrate_activity_type_ids(conn)
+                
+                # Create domains_unsubscribed table (clustered on its primary key)
+                conn.execute('CREATE TABLE IF NOT EXISTS domains_unsubscribed ' + _DOMAINS_UNSUBSCRIBED_SCHEMA)
+                
+                # Create domain_emails table: one row per sender address, replacing
+                # the emails_json array older databases kept on domains_unsubscribed
+                has_domain_emails = conn.execute(
+                    "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'domain_emails'"
+                ).fetchone()
+                conn.execute('CREATE TABLE IF NOT EXISTS domain_emails ' + _DOMAIN_EMAILS_SCHEMA)
+                if not has_domain_emails and 'emails_json' in self._table_columns(conn, 'domains_unsubscribed'):
                     conn.execute('''
-                        CREATE TABLE IF NOT EXISTS operations_history (
-                            id INTEGER PRIMARY KEY AUTOINCREMENT,
-                            user_id TEXT NOT NULL,
-                            operation_id TEXT UNIQUE NOT NULL,
-                            payload_json TEXT NOT NULL,
-                            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                            undone INTEGER DEFAULT 0,
-                            FOREIGN KEY (user_id) REFERENCES users (user_id)
-                        )
+                        INSERT OR IGNORE INTO domain_emails (user_id, domain, email)
+                        SELECT d.user_id, d.domain, e.value
+                        FROM domains_unsubscribed d, json_each(d.emails_json) e
+                        WHERE json_valid(d.emails_json) AND e.type = 'text'
                     ''')
+                
+                # Create operations_history table for undo functionality
+                conn.execute('CREATE TABLE IF NOT EXISTS operations_history ' + _OPERATIONS_HISTORY_SCHEMA)
 
-                    # Create stats_history table for tracking changes over time
-                    conn.execute('''
-                        CREATE TABLE IF NOT EXISTS stats_history (
-                            id INTEGER PRIMARY KEY AUTOINCREMENT,
-                            user_id TEXT NOT NULL,
-                            total_scanned INTEGER DEFAULT 0,
-                            total_unsubscribed INTEGER DEFAULT 0,
-                            time_saved INTEGER DEFAULT 0,
-                            emails_deleted INTEGER DEFAULT 0,
-                            recorded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                            FOREIGN KEY (user_id) REFERENCES users (user_id)
-                        )
-                    ''')
+                # Create stats_history table for tracking changes over time
+                conn.execute('CREATE TABLE IF NOT EXISTS stats_history ' + _STATS_HISTORY_SCHEMA)
 
-                    # Create indexes for better performance
-                    conn.execute('CREATE INDEX IF NOT EXISTS idx_activities_user_id ON user_activities (user_id)')
-                    conn.execute('CREATE INDEX IF NOT EXISTS idx_activities_timestamp ON user_activities (timestamp)')
-                    conn.execute('CREATE INDEX IF NOT EXISTS idx_domains_user_id ON domains_unsubscribed (user_id)')
-                    conn.execute('CREATE INDEX IF NOT EXISTS idx_operations_user_id ON operations_history (user_id)')
-                    conn.execute('CREATE INDEX IF NOT EXISTS idx_operations_operation_id ON operations_history (operation_id)')
-                    conn.execute('CREATE INDEX IF NOT EXISTS idx_stats_history_user_id ON stats_history (user_id)')
-                    conn.execute('CREATE INDEX IF NOT EXISTS idx_stats_history_recorded_at ON stats_history (recorded_at)')
-
-                    conn.commit()
-                    logger.info("Database tables and indexes created successfully")
-                    return True
-                    
+                # Older databases stored the payload as JSON text in payload_json;
+                # rename it so the rebuild below copies it into the BLOB column
+                if 'payload_json' in self._table_columns(conn, 'operations_history'):
+                    conn.execute('ALTER TABLE operations_history RENAME COLUMN payload_json TO payload')
+
+                # Bring tables from older databases up to the current shapes
+                for table, schema in (
+                    ('user_stats', _USER_STATS_SCHEMA),
+                    ('user_activities', _USER_ACTIVITIES_SCHEMA),
+                    ('domains_unsubscribed', _DOMAINS_UNSUBSCRIBED_SCHEMA),
+                    ('domain_emails', _DOMAIN_EMAILS_SCHEMA),
+                    ('operations_history', _OPERATIONS_HISTORY_SCHEMA),
+                    ('stats_history', _STATS_HISTORY_SCHEMA),
+                ):
+                    self._rebuild_table(conn, table, schema)
+
+                # Create indexes for better performance
+                # (user_id, timestamp DESC, id) serves per-user newest-first scans and trims
+                conn.execute('DROP INDEX IF EXISTS idx_activities_user_id')
+                conn.execute('CREATE INDEX IF NOT EXISTS idx_activities_user_ts ON user_activities (user_id, timestamp DESC, id)')
+                conn.execute('CREATE INDEX IF NOT EXISTS idx_activities_timestamp ON user_activities (timestamp)')
+                conn.execute('DROP INDEX IF EXISTS idx_domains_user_id')  # Covered by the primary key
+                conn.execute('CREATE INDEX IF NOT EXISTS idx_operations_user_id ON operations_history (user_id)')
+                conn.execute('CREATE INDEX IF NOT EXISTS idx_operations_operation_id ON operations_history (operation_id)')
+                # Covering index: get_stats_history reads only this index
+                conn.execute('DROP INDEX IF EXISTS idx_stats_history_user_id')
+                conn.execute('DROP INDEX IF EXISTS idx_stats_history_recorded_at')
+                conn.execute('''
+                    CREATE INDEX IF NOT EXISTS idx_stats_history_user_ts ON stats_history
+                    (user_id, recorded_at, total_scanned, total_unsubscribed, time_saved, emails_deleted)
+                ''')
+                self._migrate_daily_snapshots(conn)
+
+                self._migrate_activity_msg_ids(conn)
+                conn.execute(
+                    'CREATE UNIQUE INDEX IF NOT EXISTS idx_activities_client_msg_id '
+                    'ON user_activities (user_id, client_msg_id)'
+                )
+
+                conn.commit()
+                logger.info("Database tables and indexes created successfully")
+                return True
+            
+            return self._run_write(write)
+                
         except Exception as e:
             logger.error(f"Failed to initialize database: {e}")
             return False
     
+    def _table_columns(self, conn: sqlite3.Connection, table: str) -> List[str]:
+        """Return the column names of a table."""
+        return [row['name'] for row in conn.execute(f'PRAGMA table_info({table})')]
+    
+    def _rebuild_table(self, conn: sqlite3.Connection, table: str, schema: str) -> bool:
+        """Recreate a table with the given column definitions if its stored shape differs.
+        
+        Columns present in both shapes are copied over. Rows whose user_id no
+        longer exists in users are dropped, as the enforced foreign keys would
+        reject them. Returns True if rebuilt.
+        """
+        row = conn.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+        ).fetchone()
+        if row is None:
+            return False
+        stored = row['sql']
+        if ' '.join(stored[stored.index('('):].split()) == ' '.join(schema.split()):
+            return False
+        
+        old_columns = self._table_columns(conn, table)
+        conn.execute(f'DROP TABLE IF EXISTS {table}_new')
+        conn.execute(f'CREATE TABLE {table}_new {schema}')
+        new_columns = set(self._table_columns(conn, f'{table}_new'))
+        columns = ', '.join(column for column in old_columns if column in new_columns)
+        orphan_filter = ' WHERE user_id IN (SELECT user_id FROM users)' if 'user_id' in new_columns else ''
+        conn.execute(f'INSERT INTO {table}_new ({columns}) SELECT {columns} FROM {table}{orphan_filter}')
+        conn.execute(f'DROP TABLE {table}')
+        conn.execute(f'ALTER TABLE {table}_new RENAME TO {table}')
+        logger.info(f"Rebuilt table {table} with its current schema")
+        return True
+    
+    def _migrate_activity_type_ids(self, conn: sqlite3.Connection):
+        """Fill user_activities.type_id from the type text column of older databases.
+        
+        The type column itself is dropped when _rebuild_table reshapes the table.
+        """
+        columns = self._table_columns(conn, 'user_activities')
+        if 'type' not in columns or 'type_id' in columns:
+            return
+        conn.execute('ALTER TABLE user_activities ADD COLUMN type_id INTEGER')
+        conn.execute('INSERT OR IGNORE INTO activity_types (name) SELECT DISTINCT type FROM user_activities')
+        conn.execute('''
+            UPDATE user_activities
+            SET type_id = (SELECT id FROM activity_types WHERE name = user_activities.type)
+        ''')
+        logger.info("Converted user_activities.type to activity_types ids")
+    
+    def _ensure_activity_types(self, conn: sqlite3.Connection, names: Iterable[str]):
+        """Add activity types outside the seeded ACTIVITY_TYPES to activity_types."""
+        new_names = {name for name in names if name not in ACTIVITY_TYPES}
+        if new_names:
+            conn.executemany(_INSERT_ACTIVITY_TYPE_SQL, [(name,) for name in new_names])
+    
+    def _migrate_activity_msg_ids(self, conn: sqlite3.Connection):
+        """Add and backfill user_activities.client_msg_id on databases created without it."""
+        if 'client_msg_id' not in self._table_columns(conn, 'user_activities'):
+            conn.execute('ALTER TABLE user_activities ADD COLUMN client_msg_id TEXT')
+        
+        rows = conn.execute('''
+            SELECT a.id, t.name AS type, a.message, a.timestamp
+            FROM user_activities a JOIN activity_types t ON t.id = a.type_id
+            WHERE a.client_msg_id IS NULL
+        ''').fetchall()
+        if not rows:
+            return
+        
+        conn.executemany(
+            'UPDATE user_activities SET client_msg_id = ? WHERE id = ?',
+            [(activity_msg_id(row['type'], row['message'], row['timestamp']), row['id']) for row in rows]
+        )
+        # Drop exact duplicates left by earlier saves so the unique index can be built
+        conn.execute('''
+            DELETE FROM user_activities WHERE id NOT IN (
+                SELECT MIN(id) FROM user_activities GROUP BY user_id, client_msg_id
+            )
+        ''')
+        logger.info(f"Backfilled client_msg_id for {len(rows)} activities")
+    
+    def _migrate_daily_snapshots(self, conn: sqlite3.Connection):
+        """Keep one stats_history row per user per day, enforced by a unique index."""
+        if conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_stats_history_user_day'"
+        ).fetchone():
+            return
+        
+        # Older databases hold a row per snapshot call; keep the latest of each day
+        result = conn.execute('''
+            DELETE FROM stats_history WHERE id NOT IN (
+                SELECT MAX(id) FROM stats_history GROUP BY user_id, date(recorded_at)
+            )
+        ''')
+        if result.rowcount > 0:
+            logger.info(f"Collapsed {result.rowcount} duplicate daily stats snapshots")
+        conn.execute(
+            'CREATE UNIQUE INDEX idx_stats_history_user_day ON stats_history (user_id, date(recorded_at))'
+        )
+    
+    def _trim_user_activities(self, conn: sqlite3.Connection, user_id: str):
+        """Keep only the most recent activities for a user."""
+        conn.execute(_TRIM_ACTIVITIES_SQL, (user_id, user_id, MAX_ACTIVITIES_PER_USER))
+    
+    def _tuple_cursor(self, conn: sqlite3.Connection, sql: str) -> sqlite3.Cursor:
+        """Execute a loader query returning plain tuples, fetched LOAD_FETCH_SIZE rows at a time."""
+        cursor = conn.cursor()
+        cursor.row_factory = None  # Skip building sqlite3.Row objects for full-table scans
+        cursor.arraysize = LOAD_FETCH_SIZE
+        return cursor.execute(sql)
+    
+    def _get_cached_load(self, key: str) -> Optional[Any]:
+        """Return a cached loader result if it has not expired."""
+        with self._load_cache_lock:
+            entry = self._load_cache.get(key)
+            if entry and entry[0] > time.monotonic():
+                return entry[1]
+            return None
+    
+    def _set_cached_load(self, key: str, value: Any, version: int):
+        """Cache a loader result unless a write invalidated the cache while it was built."""
+        with self._load_cache_lock:
+            if version == self._load_cache_version:
+                self._load_cache[key] = (time.monotonic() + LOAD_CACHE_TTL_SECONDS, value)
+    
+    def invalidate_load_cache(self):
+        """Drop cached loader results after a write."""
+        with self._load_cache_lock:
+            self._load_cache.clear()
+            self._load_cache_version += 1
+    
     def ensure_user_exists(self, user_id: str) -> bool:
         """Ensure a user exists in the database. Creates if missing."""
         try:
-            with self.get_connection() as conn:
-                # Check if user exists
-                cursor = conn.execute('SELECT user_id FROM users WHERE user_id = ?', (user_id,))
-                if cursor.fetchone():
-                    # Update last_active
-                    conn.execute(
-                        'UPDATE users SET last_active = CURRENT_TIMESTAMP WHERE user_id = ?',
-                        (user_id,)
-                    )
-                else:
-                    # Create new user
-                    conn.execute(
-                        'INSERT INTO users (user_id, email) VALUES (?, ?)',
-                        (user_id, user_id)  # Using user_id as email for simplicity
-                    )
-                    # Create initial stats record
-                    conn.execute(
-                        'INSERT INTO user_stats (user_id) VALUES (?)',
-                        (user_id,)
-                    )
+            def write(conn):
+                # Create the user or update last_active
+                conn.execute(_UPSERT_USER_SQL, (user_id, user_id))  # Using user_id as email for simplicity
+                # Create initial stats record for new users
+                if conn.execute(_INSERT_USER_STATS_SQL, (user_id,)).rowcount:
                     logger.info(f"Created new user: {user_id}")
                 
                 conn.commit()
+                self.invalidate_load_cache()
                 return True
+            
+            return self._run_write(write)
                 
         except Exception as e:
             logger.error(f"Failed to ensure user exists {user_id}: {e}")
             return False
     
-    def load_user_stats(self) -> Dict[str, Dict[str, Any]]:
-        """Load all user statistics from database into memory format."""
+    def load_user_stats(self, load_emails: bool = True) -> Dict[str, Dict[str, Any]]:
+        """Load all user statistics from database into memory format.
+        
+        Each domain's 'emails' is a sorted tuple of sender addresses. With
+        load_emails=False the domain_emails table is not read and 'emails' is
+        left empty; use it when only counts and sender names are needed.
+        
+        The result is cached for LOAD_CACHE_TTL_SECONDS and shared between
+        callers, so treat it as read-only and deep-copy anything you mutate.
+        """
+        cache_key = 'user_stats' if load_emails else 'user_stats:counts'
+        cached = self._get_cached_load(cache_key)
+        if cached is not None:
+            return cached
+        version = self._load_cache_version
+        
         try:
             user_stats = {}
             
             with self.get_connection() as conn:
                 # Load basic stats
-                cursor = conn.execute('''
+                cursor = self._tuple_cursor(conn, '''
                     SELECT user_id, total_scanned, total_unsubscribed, time_saved
                     FROM user_stats
                 ''')
                 
-                for row in cursor:
-                    user_stats[row['user_id']] = {
-                        'total_scanned': row['total_scanned'],
-                        'total_unsubscribed': row['total_unsubscribed'],
-                        'time_saved': row['time_saved'],
-                        'domains_unsubscribed': {}
-                    }
+                for rows in iter(cursor.fetchmany, []):
+                    for user_id, total_scanned, total_unsubscribed, time_saved in rows:
+                        user_stats[user_id] = {
+                            'total_scanned': total_scanned,
+                            'total_unsubscribed': total_unsubscribed,
+                            'time_saved': time_saved,
+                            'domains_unsubscribed': {}
+                        }
                 
                 # Load domain statistics
-                cursor = conn.execute('''
-                    SELECT user_id, domain, sender_name, count, emails_json
+                cursor = self._tuple_cursor(conn, '''
+                    SELECT user_id, domain, sender_name, count
                     FROM domains_unsubscribed
                 ''')
                 
-                for row in cursor:
-                    user_id = row['user_id']
-                    if user_id in user_stats:
-                        try:
-                            emails_list = json.loads(row['emails_json'] or '[]')
-                            emails_set = set(emails_list)
-                        except json.JSONDecodeError:
-                            emails_set = set()
-                        
-                        user_stats[user_id]['domains_unsubscribed'][row['domain']] = {
-                            'count': row['count'],
-                            'sender_name': row['sender_name'] or row['domain'],
-                            'emails': emails_set
-                        }
+                for rows in iter(cursor.fetchmany, []):
+                    for user_id, domain, sender_name, count in rows:
+                        if user_id in user_stats:
+                            user_stats[user_id]['domains_unsubscribed'][domain] = {
+                                'count': count,
+                                'sender_name': sender_name or domain,
+                                'emails': ()
+                            }
+                
+                # Load sender addresses per domain; the primary key order groups
+                # each domain's addresses together, already sorted
+                if load_emails:
+                    domain_emails = {}
+                    cursor = self._tuple_cursor(conn, '''
+                        SELECT user_id, domain, email FROM domain_emails
+                        ORDER BY user_id, domain, email
+                    ''')
+                    for rows in iter(cursor.fetchmany, []):
+                        for user_id, domain, email in rows:
+                            domain_emails.setdefault((user_id, domain), []).append(email)
+                    for (user_id, domain), emails in domain_emails.items():
+                        domain_stats = user_stats.get(user_id, {}).get('domains_unsubscribed', {}).get(domain)
+                        if domain_stats is not None:
+                            domain_stats['emails'] = tuple(emails)
             
             logger.info(f"Loaded stats for {len(user_stats)} users from database")
+            self._set_cached_load(cache_key, user_stats, version)
             return user_stats
             
         except Exception as e:
@@ -231,172 +668,272 @@ class DatabaseManager:
             return {}
     
     def load_user_activities(self) -> Dict[str, List[Dict[str, Any]]]:
-        """Load all user activities from database into memory format."""
+        """Load all user activities from database into memory format.
+        
+        Cached and shared like load_user_stats; treat the result as read-only.
+        """
+        cached = self._get_cached_load('user_activities')
+        if cached is not None:
+            return cached
+        version = self._load_cache_version
+        
         try:
             user_activities = {}
             
             with self.get_connection() as conn:
+                type_names = dict(self._tuple_cursor(conn, 'SELECT id, name FROM activity_types'))
+                
                 # Load activities ordered by timestamp (newest first)
-                cursor = conn.execute('''
-                    SELECT user_id, type, message, metadata, timestamp
+                cursor = self._tuple_cursor(conn, '''
+                    SELECT user_id, type_id, message, metadata, timestamp
                     FROM user_activities
                     ORDER BY user_id, timestamp DESC
                 ''')
                 
-                for row in cursor:
-                    user_id = row['user_id']
-                    if user_id not in user_activities:
-                        user_activities[user_id] = []
-                    
-                    activity = {
-                        'type': row['type'],
-                        'message': row['message'],
-                        'time': row['timestamp']
-                    }
-                    
-                    # Add metadata if present
-                    if row['metadata']:
-                        try:
-                            activity['metadata'] = json.loads(row['metadata'])
-                        except json.JSONDecodeError:
-                            logger.warning(f"Invalid metadata JSON for activity: {row['metadata']}")
-                    
-                    user_activities[user_id].append(activity)
+                for rows in iter(cursor.fetchmany, []):
+                    for user_id, type_id, message, metadata, timestamp in rows:
+                        if user_id not in user_activities:
+                            user_activities[user_id] = []
+                        
+                        activity = {
+                            'type': type_names[type_id],
+                            'message': message,
+                            'time': timestamp
+                        }
+                        
+                        # Add metadata if present
+                        if metadata:
+                            try:
+                                activity['metadata'] = json_loads(metadata)
+                            except json.JSONDecodeError:
+                                logger.warning(f"Invalid metadata JSON for activity: {metadata}")
+                        
+                        user_activities[user_id].append(activity)
                 
                 # Limit to 50 most recent activities per user (matching in-memory limit)
                 for user_id in user_activities:
-                    user_activities[user_id] = user_activities[user_id][:50]
+                    user_activities[user_id] = user_activities[user_id][:MAX_ACTIVITIES_PER_USER]
             
             logger.info(f"Loaded activities for {len(user_activities)} users from database")
+            self._set_cached_load('user_activities', user_activities, version)
             return user_activities
             
         except Exception as e:
             logger.error(f"Failed to load user activities: {e}")
             return {}
     
+    def _upsert_users(self, conn: sqlite3.Connection, user_ids: List[str]):
+        """Create missing users (with an initial stats row) and touch last_active, in bulk."""
+        rows = [(user_id, user_id) for user_id in user_ids]  # Using user_id as email for simplicity
+        conn.executemany(_UPSERT_USER_SQL, rows)
+        conn.executemany(_INSERT_USER_STATS_SQL, [(user_id,) for user_id in user_ids])
+    
+    def _save_domain_emails(self, conn: sqlite3.Connection, user_id: str,
+                            domains_data: Dict[str, Dict[str, Any]]) -> int:
+        """Insert sender addresses not yet stored for a user's domains. Returns rows added."""
+        existing = set(conn.execute(
+            'SELECT domain, email FROM domain_emails WHERE user_id = ?', (user_id,)
+        ))
+        new_rows = [
+            (user_id, domain, email)
+            for domain, domain_info in domains_data.items()
+            for email in domain_info.get('emails', ())
+            if (domain, email) not in existing
+        ]
+        if new_rows:
+            conn.executemany(_INSERT_DOMAIN_EMAIL_SQL, new_rows)
+        return len(new_rows)
+    
+    def _write_user_stats(self, conn: sqlite3.Connection, user_stats: Dict[str, Dict[str, Any]]):
+        """Upsert every user's stats, domains and sender addresses on conn, without committing.
+        
+        A domain's 'emails' may be any iterable (the app keeps sets, backups
+        hold lists); duplicates are ignored.
+        """
+        stats_rows = []
+        domain_rows = []
+        for user_id, stats in user_stats.items():
+            stats_rows.append((
+                user_id,
+                stats.get('total_scanned', 0),
+                stats.get('total_unsubscribed', 0),
+                stats.get('time_saved', 0)
+            ))
+            
+            domains_data = stats.get('domains_unsubscribed', {})
+            for domain, domain_info in domains_data.items():
+                domain_rows.append((
+                    user_id,
+                    domain,
+                    domain_info.get('sender_name', domain),
+                    domain_info.get('count', 0)
+                ))
+        
+        self._upsert_users(conn, list(user_stats))
+        
+        # Update basic stats
+        conn.executemany(_UPSERT_STATS_SQL, stats_rows)
+        
+        # Update domain statistics
+        conn.executemany(_UPSERT_DOMAIN_SQL, domain_rows)
+        for user_id, stats in user_stats.items():
+            self._save_domain_emails(conn, user_id, stats.get('domains_unsubscribed', {}))
+    
+    def _write_user_activities(self, conn: sqlite3.Connection,
+                               user_activities: Dict[str, List[Dict[str, Any]]]) -> int:
+        """Insert activities not already stored (by client_msg_id) on conn, without committing.
+        
+        Returns the number of activities inserted.
+        """
+        self._upsert_users(conn, list(user_activities))
+        
+        activity_rows = []
+        trimmed_users = []
+        for user_id, activities in user_activities.items():
+            existing = {
+                row[0] for row in conn.execute(
+                    'SELECT client_msg_id FROM user_activities WHERE user_id = ?',
+                    (user_id,)
+                )
+            }
+            
+            # Insert activities oldest first so ids follow the in-memory order
+            user_row_count = len(activity_rows)
+            for activity in reversed(activities):
+                activity_type = activity.get('type', 'info')
+                message = activity.get('message', '')
+                time = activity.get('time', datetime.now().isoformat())
+                msg_id = activity_msg_id(activity_type, message, time)
+                if msg_id in existing:
+                    continue
+                existing.add(msg_id)
+                
+                metadata_json = None
+                if activity.get('metadata'):
+                    metadata_json = json_dumps(activity['metadata']).decode()
+                
+                activity_rows.append((user_id, activity_type, message, metadata_json, time, msg_id))
+            
+            if len(activity_rows) > user_row_count:
+                trimmed_users.append(user_id)
+        
+        # One batch for every user's new activities, then trim those users
+        self._ensure_activity_types(conn, {row[1] for row in activity_rows})
+        conn.executemany(_INSERT_ACTIVITY_SQL, activity_rows)
+        for user_id in trimmed_users:
+            self._trim_user_activities(conn, user_id)
+        return len(activity_rows)
+    
     def save_user_stats(self, user_stats: Dict[str, Dict[str, Any]]) -> bool:
         """Save all user statistics from memory to database."""
         try:
-            with self.lock:
-                with self.get_connection() as conn:
-                    for user_id, stats in user_stats.items():
-                        # Ensure user exists
-                        self.ensure_user_exists(user_id)
-                        
-                        # Update basic stats
-                        conn.execute('''
-                            UPDATE user_stats 
-                            SET total_scanned = ?, total_unsubscribed = ?, time_saved = ?, updated_at = CURRENT_TIMESTAMP
-                            WHERE user_id = ?
-                        ''', (
-                            stats.get('total_scanned', 0),
-                            stats.get('total_unsubscribed', 0),
-                            stats.get('time_saved', 0),
-                            user_id
-                        ))
-                        
-                        # Update domain statistics
-                        domains_data = stats.get('domains_unsubscribed', {})
-                        for domain, domain_info in domains_data.items():
-                            emails_set = domain_info.get('emails', set())
-                            emails_json = json.dumps(list(emails_set))
-                            
-                            conn.execute('''
-                                INSERT OR REPLACE INTO domains_unsubscribed 
-                                (user_id, domain, sender_name, count, emails_json, updated_at)
-                                VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
-                            ''', (
-                                user_id,
-                                domain,
-                                domain_info.get('sender_name', domain),
-                                domain_info.get('count', 0),
-                                emails_json
-                            ))
-                    
-                    conn.commit()
-                    logger.info(f"Saved stats for {len(user_stats)} users to database")
-                    return True
+            def write(conn):
+                conn.execute('BEGIN IMMEDIATE')
+                self._write_user_stats(conn, user_stats)
+                conn.commit()
+                self.invalidate_load_cache()
+                logger.info(f"Saved stats for {len(user_stats)} users to database")
+                return True
+            
+            return self._run_write(write)
                     
         except Exception as e:
             logger.error(f"Failed to save user stats: {e}")
             return False
     
     def save_user_activities(self, user_activities: Dict[str, List[Dict[str, Any]]]) -> bool:
-        """Save all user activities from memory to database."""
+        """Save all user activities from memory to database.
+        
+        Only activities not already stored (by client_msg_id) are inserted.
+        """
         try:
-            with self.lock:
-                with self.get_connection() as conn:
-                    for user_id, activities in user_activities.items():
-                        # Ensure user exists
-                        self.ensure_user_exists(user_id)
-                        
-                        # Clear existing activities for this user (we'll re-insert all)
-                        conn.execute('DELETE FROM user_activities WHERE user_id = ?', (user_id,))
-                        
-                        # Insert activities (newest first, but we'll reverse to maintain order)
-                        for activity in reversed(activities):
-                            metadata_json = None
-                            if activity.get('metadata'):
-                                metadata_json = json.dumps(activity['metadata'])
-                            
-                            conn.execute('''
-                                INSERT INTO user_activities (user_id, type, message, metadata, timestamp)
-                                VALUES (?, ?, ?, ?, ?)
-                            ''', (
-                                user_id,
-                                activity.get('type', 'info'),
-                                activity.get('message', ''),
-                                metadata_json,
-                                activity.get('time', datetime.now().isoformat())
-                            ))
-                    
-                    conn.commit()
-                    logger.info(f"Saved activities for {len(user_activities)} users to database")
-                    return True
+            def write(conn):
+                conn.execute('BEGIN IMMEDIATE')
+                inserted = self._write_user_activities(conn, user_activities)
+                conn.commit()
+                self.invalidate_load_cache()
+                logger.info(f"Saved activities for {len(user_activities)} users to database ({inserted} new)")
+                return True
+            
+            return self._run_write(write)
                     
         except Exception as e:
             logger.error(f"Failed to save user activities: {e}")
             return False
     
+    def save_user_data(self, user_stats: Dict[str, Dict[str, Any]],
+                       user_activities: Dict[str, List[Dict[str, Any]]]) -> bool:
+        """Save user statistics and activities together in a single transaction.
+        
+        Either everything is stored or nothing is, which is what bulk loads
+        such as migrate_data.py want.
+        """
+        return self.save_user_data_stream(user_stats.items(), user_activities.items())
+    
+    def save_user_data_stream(self, stats_items: Iterable[Tuple[str, Dict[str, Any]]],
+                              activity_items: Iterable[Tuple[str, List[Dict[str, Any]]]],
+                              chunk_size: int = 500) -> bool:
+        """Like save_user_data, but consumes (user_id, data) pairs from iterators.
+        
+        Users are written chunk_size at a time, so a streaming source (e.g. an
+        incremental JSON parser) never has to be held in memory as a whole.
+        The iterators are consumed on the writer thread, inside the transaction.
+        """
+        try:
+            def write(conn):
+                conn.execute('BEGIN IMMEDIATE')
+                stats_users = activity_users = inserted = 0
+                for chunk in _chunked(stats_items, chunk_size):
+                    self._write_user_stats(conn, dict(chunk))
+                    stats_users += len(chunk)
+                for chunk in _chunked(activity_items, chunk_size):
+                    inserted += self._write_user_activities(conn, dict(chunk))
+                    activity_users += len(chunk)
+                conn.commit()
+                self.invalidate_load_cache()
+                logger.info(
+                    f"Saved stats for {stats_users} users and activities for "
+                    f"{activity_users} users to database ({inserted} new activities)"
+                )
+                return True
+            
+            return self._run_write(write)
+        
+        except Exception as e:
+            logger.error(f"Failed to save user data: {e}")
+            return False
+    
     def save_single_user_stats(self, user_id: str, stats: Dict[str, Any]) -> bool:
         """Save statistics for a single user. More efficient for individual updates."""
         try:
-            with self.get_connection() as conn:
-                # Ensure user exists
-                self.ensure_user_exists(user_id)
+            def write(conn):
+                # Ensure user exists, in this transaction
+                self._upsert_users(conn, [user_id])
                 
                 # Update basic stats
-                conn.execute('''
-                    UPDATE user_stats 
-                    SET total_scanned = ?, total_unsubscribed = ?, time_saved = ?, updated_at = CURRENT_TIMESTAMP
-                    WHERE user_id = ?
-                ''', (
+                conn.execute(_UPSERT_STATS_SQL, (
+                    user_id,
                     stats.get('total_scanned', 0),
                     stats.get('total_unsubscribed', 0),
-                    stats.get('time_saved', 0),
-                    user_id
+                    stats.get('time_saved', 0)
                 ))
                 
                 # Update domain statistics
                 domains_data = stats.get('domains_unsubscribed', {})
                 for domain, domain_info in domains_data.items():
-                    emails_set = domain_info.get('emails', set())
-                    emails_json = json.dumps(list(emails_set))
-                    
-                    conn.execute('''
-                        INSERT OR REPLACE INTO domains_unsubscribed 
-                        (user_id, domain, sender_name, count, emails_json, updated_at)
-                        VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
-                    ''', (
+                    conn.execute(_UPSERT_DOMAIN_SQL, (
                         user_id,
                         domain,
                         domain_info.get('sender_name', domain),
-                        domain_info.get('count', 0),
-                        emails_json
+                        domain_info.get('count', 0)
                     ))
+                self._save_domain_emails(conn, user_id, domains_data)
                 
                 conn.commit()
+                self.invalidate_load_cache()
                 return True
+            
+            return self._run_write(write)
                 
         except Exception as e:
             logger.error(f"Failed to save stats for user {user_id}: {e}")
@@ -405,38 +942,35 @@ class DatabaseManager:
     def save_single_user_activity(self, user_id: str, activity: Dict[str, Any]) -> bool:
         """Save a single activity for a user. More efficient for individual updates."""
         try:
-            with self.get_connection() as conn:
-                # Ensure user exists
-                self.ensure_user_exists(user_id)
+            def write(conn):
+                # Ensure user exists, in this transaction
+                self._upsert_users(conn, [user_id])
                 
                 metadata_json = None
                 if activity.get('metadata'):
-                    metadata_json = json.dumps(activity['metadata'])
+                    metadata_json = json_dumps(activity['metadata']).decode()
                 
-                conn.execute('''
-                    INSERT INTO user_activities (user_id, type, message, metadata, timestamp)
-                    VALUES (?, ?, ?, ?, ?)
-                ''', (
+                activity_type = activity.get('type', 'info')
+                message = activity.get('message', '')
+                time = activity.get('time', datetime.now().isoformat())
+                self._ensure_activity_types(conn, [activity_type])
+                conn.execute(_INSERT_ACTIVITY_SQL, (
                     user_id,
-                    activity.get('type', 'info'),
-                    activity.get('message', ''),
+                    activity_type,
+                    message,
                     metadata_json,
-                    activity.get('time', datetime.now().isoformat())
+                    time,
+                    activity_msg_id(activity_type, message, time)
                 ))
                 
                 # Clean up old activities (keep only 50 most recent)
-                conn.execute('''
-                    DELETE FROM user_activities 
-                    WHERE user_id = ? AND id NOT IN (
-                        SELECT id FROM user_activities 
-                        WHERE user_id = ? 
-                        ORDER BY timestamp DESC 
-                        LIMIT 50
-                    )
-                ''', (user_id, user_id))
+                self._trim_user_activities(conn, user_id)
                 
                 conn.commit()
+                self.invalidate_load_cache()
                 return True
+            
+            return self._run_write(write)
                 
         except Exception as e:
             logger.error(f"Failed to save activity for user {user_id}: {e}")
@@ -446,45 +980,34 @@ class DatabaseManager:
         """Get database statistics for monitoring."""
         try:
             with self.get_connection() as conn:
-                stats = {}
-                
-                # Count users
-                cursor = conn.execute('SELECT COUNT(*) FROM users')
-                stats['total_users'] = cursor.fetchone()[0]
-                
-                # Count activities
-                cursor = conn.execute('SELECT COUNT(*) FROM user_activities')
-                stats['total_activities'] = cursor.fetchone()[0]
-                
-                # Count domains
-                cursor = conn.execute('SELECT COUNT(*) FROM domains_unsubscribed')
-                stats['total_domains'] = cursor.fetchone()[0]
-                
-                # Database file size
-                if os.path.exists(self.db_path):
-                    stats['db_size_bytes'] = os.path.getsize(self.db_path)
-                else:
-                    stats['db_size_bytes'] = 0
-                
-                # Most recent activity
-                cursor = conn.execute('SELECT MAX(timestamp) FROM user_activities')
-                stats['last_activity'] = cursor.fetchone()[0]
-                
-                return stats
+                total_users, total_activities, total_domains, last_activity, db_size_bytes = (
+                    conn.execute(_DATABASE_STATS_SQL).fetchone()
+                )
+                # Database size comes from SQLite's page count, so pages still
+                # in the WAL file are included
+                return {
+                    'total_users': total_users,
+                    'total_activities': total_activities,
+                    'total_domains': total_domains,
+                    'db_size_bytes': db_size_bytes,
+                    'last_activity': last_activity,
+                }
 
         except Exception as e:
             logger.error(f"Failed to get database stats: {e}")
             return {}
 
     def save_stats_snapshot(self, user_id: str, stats: Dict[str, Any]) -> bool:
-        """Save a snapshot of user statistics to history."""
+        """Save a snapshot of user statistics to history.
+        
+        History keeps one row per user per day holding the day's highest value
+        of each counter: later snapshots on the same day can only raise it, so
+        a stale snapshot (e.g. from another worker's older in-memory stats)
+        never moves the day backwards, and unchanged snapshots are skipped.
+        """
         try:
-            with self.get_connection() as conn:
-                conn.execute('''
-                    INSERT INTO stats_history
-                    (user_id, total_scanned, total_unsubscribed, time_saved, emails_deleted)
-                    VALUES (?, ?, ?, ?, ?)
-                ''', (
+            def write(conn):
+                conn.execute(_UPSERT_SNAPSHOT_SQL, (
                     user_id,
                     stats.get('total_scanned', 0),
                     stats.get('total_unsubscribed', 0),
@@ -493,6 +1016,8 @@ class DatabaseManager:
                 ))
                 conn.commit()
                 return True
+
+            return self._run_write(write)
         except Exception as e:
             logger.error(f"Failed to save stats snapshot for user {user_id}: {e}")
             return False
@@ -530,22 +1055,24 @@ class DatabaseManager:
             return []
     
     def cleanup_old_activities(self, days_to_keep: int = 30) -> bool:
-        """Clean up activities older than specified days."""
+        """Clean up activities older than specified days and refresh planner statistics."""
         try:
-            with self.lock:
-                with self.get_connection() as conn:
-                    result = conn.execute('''
-                        DELETE FROM user_activities
-                        WHERE timestamp < datetime('now', '-{} days')
-                    '''.format(days_to_keep))
+            # Same format as SQLite's datetime('now', ...) so comparisons are unchanged
+            cutoff = (datetime.now(timezone.utc) - timedelta(days=days_to_keep)).strftime('%Y-%m-%d %H:%M:%S')
+            def write(conn):
+                deleted = conn.execute(_DELETE_ACTIVITIES_BEFORE_SQL, (cutoff,)).fetchall()
+                conn.commit()
+                if deleted:
+                    self.invalidate_load_cache()
+                conn.execute('PRAGMA optimize')
 
-                    deleted_count = result.rowcount
-                    conn.commit()
+                if deleted:
+                    affected_users = {row[0] for row in deleted}
+                    logger.info(f"Cleaned up {len(deleted)} old activities for {len(affected_users)} users")
 
-                    if deleted_count > 0:
-                        logger.info(f"Cleaned up {deleted_count} old activities")
+                return True
 
-                    return True
+            return self._run_write(write)
 
         except Exception as e:
             logger.error(f"Failed to cleanup old activities: {e}")
@@ -563,22 +1090,24 @@ class DatabaseManager:
             bool: True if successful, False otherwise
         """
         try:
-            with self.get_connection() as conn:
-                # Ensure user exists
-                self.ensure_user_exists(user_id)
+            def write(conn):
+                # Ensure user exists, in this transaction
+                self._upsert_users(conn, [user_id])
 
-                # Convert payload to JSON
-                payload_json = json.dumps(payload_dict)
+                # Encode the payload as a BLOB (msgpack, or JSON bytes without it)
+                payload = pack_payload(payload_dict)
 
                 conn.execute('''
-                    INSERT INTO operations_history (user_id, operation_id, payload_json)
+                    INSERT INTO operations_history (user_id, operation_id, payload)
                     VALUES (?, ?, ?)
-                ''', (user_id, operation_id, payload_json))
+                ''', (user_id, operation_id, payload))
 
                 conn.commit()
                 logger.info(f"Saved operation {operation_id} for user {user_id}")
                 return True
 
+            return self._run_write(write)
+
         except Exception as e:
             logger.error(f"Failed to save operation {operation_id}: {e}")
             return False
@@ -595,15 +1124,11 @@ class DatabaseManager:
         """
         try:
             with self.get_connection() as conn:
-                cursor = conn.execute('''
-                    SELECT payload_json, undone
-                    FROM operations_history
-                    WHERE user_id = ? AND operation_id = ?
-                ''', (user_id, operation_id))
+                cursor = conn.execute(_SELECT_OPERATION_SQL, (user_id, operation_id))
 
                 row = cursor.fetchone()
                 if row:
-                    payload = json.loads(row['payload_json'])
+                    payload = unpack_payload(row['payload'])
                     payload['undone'] = bool(row['undone'])
                     return payload
                 else:
@@ -625,7 +1150,7 @@ class DatabaseManager:
             bool: True if successful, False otherwise
         """
         try:
-            with self.get_connection() as conn:
+            def write(conn):
                 conn.execute('''
                     UPDATE operations_history
                     SET undone = 1
@@ -636,6 +1161,8 @@ class DatabaseManager:
                 logger.info(f"Marked operation {operation_id} as undone for user {user_id}")
                 return True
 
+            return self._run_write(write)
+
         except Exception as e:
             logger.error(f"Failed to mark operation {operation_id} as undone: {e}")
             return False
@@ -650,18 +1177,16 @@ class DatabaseManager:
             bool: True if successful, False otherwise
         """
         try:
-            with self.lock:
-                with self.get_connection() as conn:
-                    # Delete from all tables
-                    conn.execute('DELETE FROM operations_history WHERE user_id = ?', (user_id,))
-                    conn.execute('DELETE FROM domains_unsubscribed WHERE user_id = ?', (user_id,))
-                    conn.execute('DELETE FROM user_activities WHERE user_id = ?', (user_id,))
-                    conn.execute('DELETE FROM user_stats WHERE user_id = ?', (user_id,))
-                    conn.execute('DELETE FROM users WHERE user_id = ?', (user_id,))
-
-                    conn.commit()
-                    logger.info(f"Deleted all data for user {user_id}")
-                    return True
+            def write(conn):
+                # Every user-scoped table cascades from users
+                conn.execute('DELETE FROM users WHERE user_id = ?', (user_id,))
+
+                conn.commit()
+                self.invalidate_load_cache()
+                logger.info(f"Deleted all data for user {user_id}")
+                return True
+
+            return self._run_write(write)
 
         except Exception as e:
             logger.error(f"Failed to delete data for user {user_id}: {e}")
@@ -9,7 +9,46 @@ import sys
 import json
 import logging
 from datetime import datetime
-from database import initialize_database, get_db_manager
+
+# ijson parses backups incrementally; without it the whole file is loaded at once
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+def _encode_set(obj):
+    """JSON default hook: encode sets as arrays and reject anything else."""
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+# orjson writes backups much faster; fall back to stdlib json.
+try:
+    import orjson
+
+    def dump_backup(data, f):
+        """Write backup data as indented JSON to a binary file, sets as arrays."""
+        f.write(orjson.dumps(data, default=_encode_set, option=orjson.OPT_INDENT_2))
+
+    def dump_backup_line(record, f):
+        """Write one NDJSON backup record to a binary file, sets as arrays."""
+        f.write(orjson.dumps(record, default=_encode_set, option=orjson.OPT_APPEND_NEWLINE))
+
+    load_backup_line = orjson.loads
+except ImportError:
+    def dump_backup(data, f):
+        """Write backup data as indented JSON to a binary file, sets as arrays."""
+        f.write(json.dumps(data, default=_encode_set, indent=2).encode('utf-8'))
+
+    def dump_backup_line(record, f):
+        """Write one NDJSON backup record to a binary file, sets as arrays."""
+        f.write(json.dumps(record, default=_encode_set).encode('utf-8') + b'\n')
+
+    load_backup_line = json.loads
+
+# Backups ending in .ndjson hold one JSON record per line: a header with the
+# backup metadata, then {"user_id", "user_stats", "user_activities"} per user
+NDJSON_SUFFIX = '.ndjson'
 
 # Set up logging
 logging.basicConfig(
@@ -21,61 +60,105 @@ logger = logging.getLogger(__name__)
 def load_backup_data(backup_file_path):
     """Load backup data from JSON file."""
     if not os.path.exists(backup_file_path):
-        logger.error(f"Backup file not found: {backup_file_path}")
+        logger.error("Backup file not found: %s", backup_file_path)
         return None, None
     
     try:
-        with open(backup_file_path, 'r') as f:
-            data = json.load(f)
-        
-        user_stats = data.get('user_stats', {})
-        user_activities = data.get('user_activities', {})
-        
-        # Convert sets back from lists for domains_unsubscribed
-        for user_id, stats in user_stats.items():
-            domains = stats.get('domains_unsubscribed', {})
-            for domain, domain_info in domains.items():
-                if 'emails' in domain_info and isinstance(domain_info['emails'], list):
-                    domain_info['emails'] = set(domain_info['emails'])
+        if backup_file_path.endswith(NDJSON_SUFFIX):
+            user_stats = dict(iter_backup_section(backup_file_path, 'user_stats'))
+            user_activities = dict(iter_backup_section(backup_file_path, 'user_activities'))
+        else:
+            with open(backup_file_path, 'r') as f:
+                data = json.load(f)
+            
+            # Domain email lists are kept as lists: the database accepts any iterable
+            user_stats = data.get('user_stats', {})
+            user_activities = data.get('user_activities', {})
         
-        logger.info(f"Loaded backup data: {len(user_stats)} users with stats, {len(user_activities)} users with activities")
+        logger.info("Loaded backup data: %s users with stats, %s users with activities",
+                    len(user_stats), len(user_activities))
         return user_stats, user_activities
         
     except Exception as e:
-        logger.error(f"Error loading backup data: {e}")
+        logger.error("Error loading backup data: %s", e)
         return None, None
 
-def create_backup(user_stats, user_activities, backup_file_path):
-    """Create a backup of current in-memory data."""
+def iter_backup_ndjson(backup_file_path):
+    """Yield the records of an NDJSON backup file one line at a time."""
+    with open(backup_file_path, 'rb') as f:
+        for line in f:
+            if line.strip():
+                yield load_backup_line(line)
+
+def iter_backup_section(backup_file_path, section):
+    """Yield (user_id, data) pairs from one top-level section of a backup file.
+    
+    NDJSON backups and, with ijson installed, JSON backups are parsed
+    incrementally, so only one user's record is in memory at a time;
+    otherwise the whole JSON file is loaded first.
+    """
+    if backup_file_path.endswith(NDJSON_SUFFIX):
+        for record in iter_backup_ndjson(backup_file_path):
+            if 'user_id' in record and section in record:
+                yield record['user_id'], record[section]
+        return
+    
+    with open(backup_file_path, 'rb') as f:
+        if ijson is not None:
+            items = ijson.kvitems(f, section, use_float=True)
+        else:
+            items = json.load(f).get(section, {}).items()
+        yield from items
+
+def create_backup_ndjson(user_stats, user_activities, f, backup_type='pre_migration'):
+    """Write a backup as NDJSON, one line per user, to a binary file."""
+    dump_backup_line({
+        'backup_timestamp': datetime.now().isoformat(),
+        'backup_type': backup_type
+    }, f)
+    for user_id in dict.fromkeys([*user_stats, *user_activities]):
+        record = {'user_id': user_id}
+        if user_id in user_stats:
+            record['user_stats'] = user_stats[user_id]
+        if user_id in user_activities:
+            record['user_activities'] = user_activities[user_id]
+        dump_backup_line(record, f)
+
+def create_backup(user_stats, user_activities, backup_file_path, backup_type='pre_migration'):
+    """Create a backup of current in-memory data.
+    
+    Paths ending in .ndjson are written one record per user, which can be
+    migrated without holding the whole backup in memory.
+    """
     try:
-        # Convert sets to lists for JSON serialization
-        backup_stats = {}
-        for user_id, stats in user_stats.items():
-            backup_stats[user_id] = stats.copy()
-            domains = backup_stats[user_id].get('domains_unsubscribed', {})
-            for domain, domain_info in domains.items():
-                if 'emails' in domain_info and isinstance(domain_info['emails'], set):
-                    domain_info['emails'] = list(domain_info['emails'])
+        with open(backup_file_path, 'wb') as f:
+            if backup_file_path.endswith(NDJSON_SUFFIX):
+                create_backup_ndjson(user_stats, user_activities, f, backup_type)
+            else:
+                # Email sets are written as JSON arrays by dump_backup
+                dump_backup({
+                    'user_stats': user_stats,
+                    'user_activities': user_activities,
+                    'backup_timestamp': datetime.now().isoformat(),
+                    'backup_type': backup_type
+                }, f)
         
-        backup_data = {
-            'user_stats': backup_stats,
-            'user_activities': user_activities,
-            'backup_timestamp': datetime.now().isoformat(),
-            'backup_type': 'pre_migration'
-        }
-        
-        with open(backup_file_path, 'w') as f:
-            json.dump(backup_data, f, indent=2)
-        
-        logger.info(f"Created backup at: {backup_file_path}")
+        logger.info("Created backup at: %s", backup_file_path)
         return True
         
     except Exception as e:
-        logger.error(f"Error creating backup: {e}")
+        logger.error("Error creating backup: %s", e)
         return False
 
 def migrate_to_database(user_stats, user_activities, db_path="gmail_unsubscriber.db"):
-    """Migrate data to SQLite database."""
+    """Migrate data to SQLite database.
+    
+    user_stats and user_activities are dicts keyed by user_id, or iterables of
+    (user_id, data) pairs such as iter_backup_section() yields.
+    """
+    # Imported here so the usage and backup commands don't load the database layer
+    from database import initialize_database, get_db_manager
+    
     try:
         # Initialize database
         logger.info("Initializing database...")
@@ -89,65 +172,83 @@ def migrate_to_database(user_stats, user_activities, db_path="gmail_unsubscriber
             logger.error("Could not get database manager")
             return False
         
-        # Save data to database
-        logger.info("Migrating user statistics...")
-        stats_success = db_manager.save_user_stats(user_stats)
+        # Save data to database in one transaction, so a failed migration leaves nothing behind
+        logger.info("Migrating user statistics and activities...")
+        if isinstance(user_stats, dict):
+            user_stats = user_stats.items()
+        if isinstance(user_activities, dict):
+            user_activities = user_activities.items()
+        success = db_manager.save_user_data_stream(user_stats, user_activities)
         
-        logger.info("Migrating user activities...")
-        activities_success = db_manager.save_user_activities(user_activities)
-        
-        if stats_success and activities_success:
+        if success:
             logger.info("Migration completed successfully!")
             
             # Get database stats for verification
             db_stats = db_manager.get_database_stats()
-            logger.info(f"Database stats after migration: {db_stats}")
+            logger.info("Database stats after migration: %s", db_stats)
             
             return True
         else:
-            logger.error("Migration partially failed")
+            logger.error("Migration failed, no data was written")
             return False
             
     except Exception as e:
-        logger.error(f"Error during migration: {e}")
+        logger.error("Error during migration: %s", e)
         return False
 
 def verify_migration(user_stats, user_activities, db_path="gmail_unsubscriber.db"):
     """Verify that migrated data matches original data."""
+    from database import get_db_manager
+    
     try:
         db_manager = get_db_manager()
         if not db_manager:
             logger.error("Database manager not available for verification")
             return False
         
-        # Load data from database
-        loaded_stats = db_manager.load_user_stats()
+        # Load data from database (only counters are compared, so skip sender addresses)
+        loaded_stats = db_manager.load_user_stats(load_emails=False)
         loaded_activities = db_manager.load_user_activities()
         
-        # Compare stats
-        stats_match = True
-        for user_id, original_stats in user_stats.items():
-            if user_id not in loaded_stats:
-                logger.error(f"User {user_id} missing from loaded stats")
-                stats_match = False
-                continue
-            
-            loaded_user_stats = loaded_stats[user_id]
-            for key in ['total_scanned', 'total_unsubscribed', 'time_saved']:
-                if original_stats.get(key, 0) != loaded_user_stats.get(key, 0):
-                    logger.error(f"Stats mismatch for {user_id}.{key}: {original_stats.get(key)} vs {loaded_user_stats.get(key)}")
-                    stats_match = False
+        # Users missing from the database, found with one set difference each
+        missing_users = user_stats.keys() - loaded_stats.keys()
+        for user_id in sorted(missing_users):
+            logger.error("User %s missing from loaded stats", user_id)
+        missing_activity_users = user_activities.keys() - loaded_activities.keys()
+        for user_id in sorted(missing_activity_users):
+            logger.error("User %s missing from loaded activities", user_id)
+        
+        # Compare stats of the users present on both sides as sets of
+        # (user_id, key, value): the symmetric difference holds exactly the
+        # values that do not match
+        stat_keys = ('total_scanned', 'total_unsubscribed', 'time_saved')
+        common_users = user_stats.keys() & loaded_stats.keys()
+        original_values = {
+            (user_id, key, user_stats[user_id].get(key, 0))
+            for user_id in common_users for key in stat_keys
+        }
+        loaded_values = {
+            (user_id, key, loaded_stats[user_id].get(key, 0))
+            for user_id in common_users for key in stat_keys
+        }
+        mismatches = original_values ^ loaded_values
+        stats_match = not missing_users and not mismatches
+        
+        # Log the mismatches grouped by user
+        expected = {(user_id, key): value for user_id, key, value in original_values - loaded_values}
+        for user_id in sorted({user_id for user_id, _ in expected}):
+            for key in stat_keys:
+                if (user_id, key) in expected:
+                    logger.error("Stats mismatch for %s.%s: %s vs %s",
+                                 user_id, key, expected[user_id, key], loaded_stats[user_id].get(key, 0))
         
         # Compare activities (basic count check)
-        activities_match = True
-        for user_id, original_activities in user_activities.items():
-            if user_id not in loaded_activities:
-                logger.error(f"User {user_id} missing from loaded activities")
-                activities_match = False
-                continue
-            
+        activities_match = not missing_activity_users
+        for user_id in user_activities.keys() & loaded_activities.keys():
+            original_activities = user_activities[user_id]
             if len(original_activities) != len(loaded_activities[user_id]):
-                logger.warning(f"Activity count mismatch for {user_id}: {len(original_activities)} vs {len(loaded_activities[user_id])}")
+                logger.warning("Activity count mismatch for %s: %s vs %s",
+                               user_id, len(original_activities), len(loaded_activities[user_id]))
                 # This might be OK due to 50-item limit
         
         if stats_match:
@@ -163,7 +264,7 @@ def verify_migration(user_stats, user_activities, db_path="gmail_unsubscriber.db
         return stats_match
         
     except Exception as e:
-        logger.error(f"Error during verification: {e}")
+        logger.error("Error during verification: %s", e)
         return False
 
 def main():
@@ -178,6 +279,7 @@ def main():
         print("  python migrate_data.py migrate <backup_file>         - Migrate from backup to database")
         print("  python migrate_data.py migrate_live                  - Migrate from current app memory")
         print("  python migrate_data.py verify <backup_file>          - Verify migration")
+        print("Backup files ending in .ndjson use one JSON record per user per line")
         sys.exit(1)
     
     command = sys.argv[1]
@@ -191,21 +293,10 @@ def main():
         
         # This would require importing the current app state
         # For now, we'll create a sample backup structure
-        logger.info(f"Creating backup structure at {backup_file}")
-        sample_data = {
-            'user_stats': {},
-            'user_activities': {},
-            'backup_timestamp': datetime.now().isoformat(),
-            'backup_type': 'manual'
-        }
-        
-        try:
-            with open(backup_file, 'w') as f:
-                json.dump(sample_data, f, indent=2)
-            logger.info(f"Sample backup created at {backup_file}")
-        except Exception as e:
-            logger.error(f"Error creating backup: {e}")
+        logger.info("Creating backup structure at %s", backup_file)
+        if not create_backup({}, {}, backup_file, backup_type='manual'):
             sys.exit(1)
+        logger.info("Sample backup created at %s", backup_file)
     
     elif command == "migrate":
         if len(sys.argv) < 3:
@@ -213,14 +304,15 @@ def main():
             sys.exit(1)
         
         backup_file = sys.argv[2]
-        
-        # Load data from backup
-        user_stats, user_activities = load_backup_data(backup_file)
-        if user_stats is None:
+        if not os.path.exists(backup_file):
+            logger.error("Backup file not found: %s", backup_file)
             sys.exit(1)
         
-        # Migrate to database
-        success = migrate_to_database(user_stats, user_activities)
+        # Stream users from the backup straight into the database
+        success = migrate_to_database(
+            iter_backup_section(backup_file, 'user_stats'),
+            iter_backup_section(backup_file, 'user_activities')
+        )
         if success:
             logger.info("Migration completed successfully!")
         else:
@@ -252,7 +344,7 @@ def main():
             sys.exit(1)
     
     else:
-        logger.error(f"Unknown command: {command}")
+        logger.error("Unknown command: %s", command)
         sys.exit(1)
 
 if __name__ == "__main__":
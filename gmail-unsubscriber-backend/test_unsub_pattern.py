@@ -0,0 +1,66 @@
+"""
+Regression checks for the unsubscribe link pattern in app.py.
+
+Email HTML is attacker-controlled and _UNSUB_RE runs on every anchor's href
+and text, so a pattern that backtracks catastrophically can stall a scan.
+"""
+
+import os
+import sys
+import time
+
+import pytest
+
+pytest.importorskip('flask')
+pytest.importorskip('bs4')
+pytest.importorskip('googleapiclient')
+
+# Searches of the old pattern took 25+ seconds on these inputs
+ADVERSARIAL_INPUTS = [
+    "email-" * 20000,
+    "manage_" * 20000,
+    "email " * 20000,
+    "https://x.com/?q=" + "manage-" * 20000,
+]
+
+
+@pytest.fixture(scope='module')
+def unsub_re(tmp_path_factory):
+    """Import app from a scratch directory so its log and database stay out of the tree."""
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp('app'))
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    try:
+        import app
+    finally:
+        os.chdir(cwd)
+    return app._UNSUB_RE
+
+
+@pytest.mark.parametrize('text', [
+    "Unsubscribe",
+    "Click here to opt-out",
+    "opt_out",
+    "Manage your email preferences",
+    "https://example.com/email-preferences",
+    "manage_preferences",
+    "manage-my-email-preferences",
+])
+def test_matches_unsubscribe_wording(unsub_re, text):
+    assert unsub_re.search(text)
+
+
+@pytest.mark.parametrize('text', [
+    "View in browser",
+    "https://example.com/preferences",
+    "Update your profile",
+])
+def test_ignores_other_links(unsub_re, text):
+    assert not unsub_re.search(text)
+
+
+@pytest.mark.parametrize('text', ADVERSARIAL_INPUTS, ids=lambda text: text[:12])
+def test_adversarial_input_is_linear(unsub_re, text):
+    start = time.perf_counter()
+    assert not unsub_re.search(text)
+    assert time.perf_counter() - start < 1.0
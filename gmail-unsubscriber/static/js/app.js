@@ -897,6 +897,9 @@ function startStatusPolling() {
                 // Check if process is complete
                 if (data.processing.status === 'completed') {
                     finishUnsubscriptionProcess();
+                } else if (data.processing.status === 'error') {
+                    currentProcessingStatus = `Error: ${data.processing.error || 'Unsubscription process failed'}`;
+                    stopUnsubscriptionProcess();
                 }
             } else {
                 // Update status based on current progress